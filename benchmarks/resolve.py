@@ -0,0 +1,228 @@
+# Copyright 2013 Johan Rydberg.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Benchmarks for the resolution hot path.
+
+Starts an in-process fake service registry, and drives the resolver,
+`query_formation`, formation caches and `ResolveAdapter` against it:
+
+    $ python benchmarks/resolve.py --instances 500 --latency 0.002 \\
+          --concurrency 16 --requests 2000 resolve cached-resolve adapter
+
+The fake registry also answers plain HTTP requests on `/ping`, and
+announces all its instances on its own address, so the adapter
+benchmark makes real round-trips.
+"""
+
+import argparse
+import BaseHTTPServer
+import hashlib
+import json
+import os
+import SocketServer
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from requests.adapters import HTTPAdapter
+import requests
+
+from gilliam.adapter import ResolveAdapter
+from gilliam.service_registry import (CachedResolver, Resolver,
+                                      ServiceRegistryClient)
+from gilliam.util import thread
+
+
+FORMATION = 'bench'
+
+
+class FakeRegistry(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """A service registry that holds a single formation of
+    `instances` instances, and answers after `latency` seconds.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, instances, latency, services=4):
+        BaseHTTPServer.HTTPServer.__init__(
+            self, ('127.0.0.1', 0), _RegistryHandler)
+        self.latency = latency
+        port = str(self.server_port)
+        formation = {}
+        for i in range(instances):
+            service = 'svc%d' % (i % services,)
+            formation['%s.%d' % (service, i)] = {
+                'formation': FORMATION, 'service': service,
+                'instance': str(i), 'host': '127.0.0.1',
+                'ports': {'80': port}}
+        self.body = json.dumps(formation)
+        self.etag = '"%s"' % (hashlib.sha1(self.body).hexdigest(),)
+        self.requests = 0
+        self._lock = threading.Lock()
+
+    def count(self):
+        with self._lock:
+            self.requests += 1
+
+    @property
+    def address(self):
+        return '127.0.0.1:%d' % (self.server_port,)
+
+    def start(self):
+        thread(self.serve_forever)
+        return self
+
+    def handle_error(self, request, client_address):
+        # clients hanging up on keep-alive connections is expected.
+        pass
+
+
+class _RegistryHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def _reply(self, status, body='', headers={}):
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        server = self.server
+        if self.path == '/ping':
+            return self._reply(200, 'pong')
+        server.count()
+        time.sleep(server.latency)
+        if self.path != '/' + FORMATION:
+            return self._reply(200, '{}')
+        if self.headers.get('If-None-Match') == server.etag:
+            return self._reply(304)
+        self._reply(200, server.body, {'ETag': server.etag,
+                                       'Content-Type': 'application/json'})
+
+    def do_PUT(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        self.server.count()
+        time.sleep(self.server.latency)
+        self._reply(200)
+
+    def log_message(self, *args):
+        pass
+
+
+def _percentile(samples, percentile):
+    index = min(len(samples) - 1, len(samples) * percentile // 100)
+    return samples[index]
+
+
+def run(name, op, concurrency, count):
+    """Call `op` `count` times spread over `concurrency` threads and
+    report throughput and latency.
+    """
+    latencies = []
+    lock = threading.Lock()
+
+    def worker(n):
+        samples = []
+        for _ in xrange(n):
+            t0 = time.time()
+            op()
+            samples.append(time.time() - t0)
+        with lock:
+            latencies.extend(samples)
+
+    per_worker = max(1, count // concurrency)
+    t0 = time.time()
+    workers = [thread(worker, per_worker) for _ in range(concurrency)]
+    for t in workers:
+        t.join()
+    elapsed = time.time() - t0
+
+    latencies.sort()
+    print '%-16s %8d ops %10.1f ops/s   p50 %8.3f ms   p99 %8.3f ms' % (
+        name, len(latencies), len(latencies) / elapsed,
+        _percentile(latencies, 50) * 1000, _percentile(latencies, 99) * 1000)
+
+
+def benchmarks(client, selected=(), service='svc0'):
+    """Yield the name and operation of each benchmark in `selected`,
+    or of all benchmarks if empty.  Whatever a benchmark needs is only
+    set up if it is selected.
+    """
+    url = 'http://%s.%s.service:80/ping' % (service, FORMATION)
+
+    def wanted(name):
+        return not selected or name in selected
+
+    if wanted('resolve'):
+        resolver = Resolver(client)
+        yield 'resolve', lambda: resolver.resolve_url(url)
+
+    if wanted('cached-resolve'):
+        cached = CachedResolver(client)
+        yield 'cached-resolve', lambda: cached.resolve_url(url)
+
+    if wanted('query'):
+        yield 'query', lambda: list(client.query_formation(FORMATION))
+
+    if wanted('query-stream'):
+        yield 'query-stream', lambda: list(client.query_formation(
+                FORMATION, stream=True))
+
+    if wanted('cache-update'):
+        cache = client.formation_cache(FORMATION, interval=3600)
+        yield 'cache-update', cache._update
+        cache.stop()
+
+    if wanted('cache-watch'):
+        watching = client.formation_cache(FORMATION, interval=3600,
+                                          watch=True)
+        yield 'cache-watch', watching._update
+        watching.stop()
+
+    if wanted('adapter'):
+        http = requests.Session()
+        http.mount('http://', ResolveAdapter(HTTPAdapter(),
+                                             CachedResolver(client)))
+        yield 'adapter', lambda: http.get(url).content
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--instances', type=int, default=100,
+                        help='number of instances in the formation')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='seconds the registry takes to answer')
+    parser.add_argument('--concurrency', type=int, default=4,
+                        help='number of threads issuing operations')
+    parser.add_argument('--requests', type=int, default=1000,
+                        help='total number of operations per benchmark')
+    parser.add_argument('benchmark', nargs='*',
+                        help='benchmarks to run (default: all)')
+    args = parser.parse_args()
+
+    registry = FakeRegistry(args.instances, args.latency).start()
+    client = ServiceRegistryClient(time, [registry.address])
+
+    for name, op in benchmarks(client, args.benchmark):
+        before = registry.requests
+        run(name, op, args.concurrency, args.requests)
+        print '%-16s %8d registry requests' % ('', registry.requests - before)
+
+
+if __name__ == '__main__':
+    main()
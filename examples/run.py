@@ -15,7 +15,6 @@
 """Simple example of how to run an arbitraty image on an executor."""
 
 import contextlib
-from functools import partial
 import os
 import sys
 import termios
@@ -62,12 +61,11 @@ def example():
     http.mount('ws://', ResolveAdapter(WebSocketAdapter(), resolver))
 
     client = ExecutorClient(http)
-    reader = iter(partial(sys.stdin.read, 1), '')
 
     process = client.run('examples', 'ubuntu', {}, ['/bin/bash'],
                          tty=os.isatty(sys.stdin.fileno()))
     with console():
-        _thread(process.attach, reader, sys.stdout, replay=True)
+        _thread(process.attach, sys.stdin, sys.stdout, replay=True)
         exit_code = process.wait()
 
     sys.exit(exit_code)
@@ -12,9 +12,13 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import socket
+import time
+
 from requests.auth import _basic_auth_str
 from requests.adapters import BaseAdapter
 from requests.compat import urlparse, unquote
+from requests.exceptions import ConnectionError
 from requests.models import Response
 from requests.utils import get_auth_from_url
 
@@ -25,18 +29,50 @@ class ResolveAdapter(object):
     """An adapter to request adapters that before sending the request,
     resolves the URL using a service registry client resolver.
 
+    The number of outstanding requests and the response time of each
+    resolved endpoint are reported back to the balancer of the
+    resolver.  Endpoints that refuse connections are reported to its
+    outlier detector.  Resolvers without a `balancer` or `outliers`
+    are left out of the respective reports.
+
     See :class:`Resolver <gilliam.service_registry.Resolver`.
     """
 
-    def __init__(self, original, resolver):
+    def __init__(self, original, resolver, clock=time):
         self.original = original
         self._resolver = resolver
+        self._clock = clock
 
     def send(self, request, *args, **kwargs):
         netloc = urlparse(request.url).netloc
         request.headers['Host'] = netloc
-        request.prepare_url(self._resolver.resolve_url(request.url), {})
-        return self.original.send(request, *args, **kwargs)
+        url = self._resolver.resolve_url(request.url)
+        request.prepare_url(url, {})
+
+        balancer = getattr(self._resolver, 'balancer', None)
+        outliers = getattr(self._resolver, 'outliers', None)
+        if balancer is None and outliers is None:
+            return self.original.send(request, *args, **kwargs)
+
+        host, port = urlparse(url).netloc.rsplit(':', 1)
+        endpoint = (host, int(port))
+        if balancer is not None:
+            balancer.started(endpoint)
+        failed = True
+        t0 = self._clock.time()
+        try:
+            response = self.original.send(request, *args, **kwargs)
+            if outliers is not None:
+                outliers.succeeded(endpoint)
+            failed = response.status_code >= 500
+            return response
+        except (ConnectionError, socket.error):
+            if outliers is not None:
+                outliers.failed(endpoint)
+            raise
+        finally:
+            if balancer is not None:
+                balancer.finished(endpoint, self._clock.time() - t0, failed)
 
     def close(self):
         self.original.close()
@@ -45,8 +81,15 @@ class ResolveAdapter(object):
 class WebSocketAdapter(BaseAdapter):
     """Basic WebSocket adapter for `ws://` and `wss://` URLs.
     Supports proxies.
+
+    Connections refuse messages larger than `max_message_size` bytes,
+    if given.
     """
 
+    def __init__(self, max_message_size=None):
+        super(WebSocketAdapter, self).__init__()
+        self.max_message_size = max_message_size
+
     def proxy_headers(self, proxy):
         headers = {}
         username, password = get_auth_from_url(proxy)
@@ -72,9 +115,11 @@ class WebSocketAdapter(BaseAdapter):
             return websocket.create_connection(
                 url,
                 proxy=self._proxy_from_url(proxy),
-                proxy_header=self.proxy_headers(proxy))
+                proxy_header=self.proxy_headers(proxy),
+                max_message_size=self.max_message_size)
         else:
-            return websocket.create_connection(url)
+            return websocket.create_connection(
+                url, max_message_size=self.max_message_size)
 
     def send(self, request, stream=False, timeout=None, verify=True,
              cert=None, proxies=None):
@@ -0,0 +1,69 @@
+# Copyright 2013 Johan Rydberg.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Running processes on executors from asyncio.
+
+Wraps the futures of :class:`gilliam.executor.ExecutorClient`, so
+that processes are started by its thread pool and waited on by its
+status tracker.  Cancelling a coroutine cancels the underlying
+future.
+"""
+
+import trollius as asyncio
+from trollius import From, Return
+
+from ..executor import ExecutorClient as _ExecutorClient
+
+
+class ExecutorClient(object):
+    """Asyncio client interface for the executor."""
+
+    def __init__(self, client, host='api.executor.service', port=9000,
+                 max_poll_rate=50, max_workers=8, loop=None):
+        self.executor = _ExecutorClient(client, host, port, max_poll_rate,
+                                        max_workers)
+        self.loop = loop or asyncio.get_event_loop()
+
+    @asyncio.coroutine
+    def run(self, formation, image, env, command, tty=False):
+        """Start a process and return it once the executor has
+        answered.
+        """
+        process = yield From(asyncio.wrap_future(
+                self.executor.run_async(formation, image, env, command, tty),
+                loop=self.loop))
+        raise Return(process)
+
+    @asyncio.coroutine
+    def wait(self, process, timeout=None):
+        """Wait for `process` to exit and return its exit code, or
+        `None` if timeout.
+        """
+        future = asyncio.wrap_future(process.result_future(),
+                                     loop=self.loop)
+        try:
+            status = yield From(asyncio.wait_for(future, timeout,
+                                                 loop=self.loop))
+        except asyncio.TimeoutError:
+            status = None
+        raise Return(status)
+
+    @asyncio.coroutine
+    def wait_for_state(self, process, *states):
+        """Wait for `process` to enter one of `states` and return the
+        state.
+        """
+        state = yield From(asyncio.wrap_future(
+                process.state_future(*states), loop=self.loop))
+        raise Return(state)
@@ -0,0 +1,191 @@
+# Copyright 2013 Johan Rydberg.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Minimal HTTP/1.1 client on top of asyncio streams.
+
+Just enough to talk to Gilliam services: requests and responses are
+held in memory, and idle connections are kept alive per host.
+"""
+
+import json
+import socket
+from urlparse import urlsplit
+
+import trollius as asyncio
+from trollius import From, Return
+
+
+class TransportError(IOError):
+    """Could not talk to the server."""
+
+
+class HTTPError(Exception):
+    """The server answered with an error status."""
+
+    def __init__(self, message, response):
+        Exception.__init__(self, message)
+        self.response = response
+
+
+class Response(object):
+    """A response to an HTTP request.  Header names are lower-case."""
+
+    def __init__(self, status_code, reason, headers, content):
+        self.status_code = status_code
+        self.reason = reason
+        self.headers = headers
+        self.content = content
+
+    def json(self):
+        return json.loads(self.content)
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise HTTPError('%d %s' % (self.status_code, self.reason), self)
+
+
+class HTTPClient(object):
+    """HTTP client that keeps up to `max_idle` idle connections per
+    host for reuse.
+    """
+
+    def __init__(self, loop=None, max_idle=8):
+        self.loop = loop or asyncio.get_event_loop()
+        self.max_idle = max_idle
+        self._idle = {}
+
+    def close(self):
+        for conns in self._idle.values():
+            for reader, writer in conns:
+                writer.close()
+        self._idle.clear()
+
+    @asyncio.coroutine
+    def request(self, method, url, data=None, headers=None, timeout=None):
+        """Issue a request and return its :class:`Response`.
+
+        :raises: TransportError
+        """
+        coro = self._request(method, url, data, headers or {})
+        if timeout is not None:
+            coro = asyncio.wait_for(coro, timeout, loop=self.loop)
+        try:
+            response = yield From(coro)
+        except asyncio.TimeoutError:
+            raise TransportError('%s %s: timed out' % (method, url))
+        except (socket.error, asyncio.IncompleteReadError, ValueError), err:
+            raise TransportError('%s %s: %s' % (method, url, err))
+        raise Return(response)
+
+    def _checkout(self, key):
+        conns = self._idle.get(key)
+        while conns:
+            reader, writer = conns.pop()
+            if not reader.at_eof():
+                return reader, writer
+            writer.close()
+        return None
+
+    def _checkin(self, key, conn):
+        conns = self._idle.setdefault(key, [])
+        if len(conns) < self.max_idle:
+            conns.append(conn)
+        else:
+            conn[1].close()
+
+    @asyncio.coroutine
+    def _request(self, method, url, data, headers):
+        u = urlsplit(url)
+        key = (u.hostname, u.port or 80)
+        path = u.path or '/'
+        if u.query:
+            path += '?' + u.query
+        lines = ['%s %s HTTP/1.1' % (method, path), 'Host: %s' % (u.netloc,)]
+        if data is not None or method not in ('GET', 'HEAD'):
+            lines.append('Content-Length: %d' % (len(data or ''),))
+        lines.extend('%s: %s' % (k, v) for (k, v) in headers.items())
+        head = '\r\n'.join(lines) + '\r\n\r\n'
+
+        while True:
+            conn = self._checkout(key)
+            reused = conn is not None
+            if not reused:
+                conn = yield From(asyncio.open_connection(
+                        key[0], key[1], loop=self.loop))
+            reader, writer = conn
+            try:
+                writer.write(head)
+                if data:
+                    writer.write(data)
+                status_line = yield From(reader.readline())
+                if status_line or not reused:
+                    result = yield From(self._read_response(
+                            method, status_line, reader))
+            except:
+                writer.close()
+                raise
+            if status_line or not reused:
+                break
+            # the server closed the idle connection under our feet.
+            writer.close()
+
+        response, keep_alive = result
+        if keep_alive:
+            self._checkin(key, conn)
+        else:
+            writer.close()
+        raise Return(response)
+
+    @asyncio.coroutine
+    def _read_response(self, method, status_line, reader):
+        if not status_line:
+            raise TransportError('connection closed')
+        parts = status_line.split(' ', 2)
+        status = int(parts[1])
+        reason = parts[2].strip() if len(parts) > 2 else ''
+
+        headers = {}
+        while True:
+            line = yield From(reader.readline())
+            if line in ('\r\n', '\n', ''):
+                break
+            name, value = line.split(':', 1)
+            headers[name.strip().lower()] = value.strip()
+
+        keep_alive = (status_line.startswith('HTTP/1.1')
+                      and headers.get('connection', '').lower() != 'close')
+        if method == 'HEAD' or status in (204, 304) or status < 200:
+            content = ''
+        elif headers.get('transfer-encoding', '').lower() == 'chunked':
+            chunks = []
+            while True:
+                line = yield From(reader.readline())
+                size = int(line.split(';', 1)[0], 16)
+                if not size:
+                    break
+                chunk = yield From(reader.readexactly(size + 2))
+                chunks.append(chunk[:-2])
+            while True:
+                line = yield From(reader.readline())
+                if line in ('\r\n', '\n', ''):
+                    break
+            content = ''.join(chunks)
+        elif 'content-length' in headers:
+            content = yield From(reader.readexactly(
+                    int(headers['content-length'])))
+        else:
+            content = yield From(reader.read())
+            keep_alive = False
+
+        raise Return((Response(status, reason, headers, content), keep_alive))
@@ -0,0 +1,380 @@
+# Copyright 2013 Johan Rydberg.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Service discovery on top of asyncio.
+
+Same semantics as :mod:`gilliam.service_registry`, but every call that
+talks to the registry is a coroutine, and formation caches and
+registrations are tasks rather than threads.
+"""
+
+import json
+import logging
+import os
+import random
+import time
+from urlparse import urljoin, urlsplit, urlunsplit
+
+from circuit import CircuitBreakerSet, CircuitOpenError
+import trollius as asyncio
+from trollius import From, Return
+
+from ..service_registry import CachedResolver, _FormationSnapshot
+from .http import HTTPClient, TransportError
+
+
+class ServerError(TransportError):
+    """The registry node answered with a server error."""
+
+
+class _Registration(object):
+    """A service registration, kept alive by a task."""
+
+    def __init__(self, client, form_name, service, instance_name, data,
+                 interval=3, lease_only=False):
+        self.log = logging.getLogger('{0}.reg.{1}/{2}.{3}'.format(
+                __name__, form_name, service, instance_name))
+        self.client = client
+        self.interval = interval
+        self.lease_only = lease_only
+        self.uri = '/%s/%s.%s' % (form_name, service, instance_name)
+        self._set_data(data)
+        self._lease_failed = False
+        self._wakeup = asyncio.Event(loop=client.loop)
+        self._task = None
+
+    def _set_data(self, data):
+        self.data = data
+        self._body = json.dumps(data)
+        self._announced = False
+
+    def update(self, data):
+        """Change the announcement and send it to the registry right
+        away.
+        """
+        self._set_data(data)
+        self._wakeup.set()
+
+    @asyncio.coroutine
+    def _announce(self):
+        body = self._body
+        response = yield From(self.client._request(
+                'PUT', self.uri, data=body, timeout=self.interval))
+        # the data may have been updated while the request was in
+        # flight, in which case the new data has not been announced.
+        if self._body is body:
+            self._announced = response.status_code < 400
+
+    @asyncio.coroutine
+    def _extend(self):
+        response = yield From(self.client._request(
+                'POST', self.uri + '/lease', timeout=self.interval))
+        if response.status_code < 400:
+            self._lease_failed = False
+            return
+        if self._lease_failed:
+            self.log.warning("registry does not extend leases; "
+                             "sending full announcements")
+            self.lease_only = False
+        self._lease_failed = True
+        yield From(self._announce())
+
+    @asyncio.coroutine
+    def _loop(self):
+        while True:
+            try:
+                if self.lease_only and self._announced:
+                    yield From(self._extend())
+                else:
+                    yield From(self._announce())
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                self.log.exception("could not talk to service registry")
+            try:
+                yield From(asyncio.wait_for(self._wakeup.wait(),
+                                            self.interval,
+                                            loop=self.client.loop))
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+
+    def start(self):
+        self._task = asyncio.ensure_future(self._loop(),
+                                           loop=self.client.loop)
+        return self
+
+    def stop(self):
+        self._task.cancel()
+
+
+class _FormationCache(object):
+    """A cache of instance data for a formation, kept up to date by a
+    task.  See :class:`gilliam.service_registry._FormationCache`.
+    """
+
+    def __init__(self, client, form_name, factory, interval, watch=False):
+        self.log = logging.getLogger('{0}.cache.{1}'.format(
+                __name__, form_name))
+        self.client = client
+        self.form_name = form_name
+        self.factory = factory
+        self.interval = interval
+        self.watch = watch
+        self._cache = {}
+        self._raw = {}
+        self._etag = None
+        self._task = None
+
+    @asyncio.coroutine
+    def start(self):
+        """Start the cache and wait for it to be filled."""
+        yield From(self._update())
+        self._task = asyncio.ensure_future(self._loop(),
+                                           loop=self.client.loop)
+        raise Return(self)
+
+    def stop(self):
+        self._task.cancel()
+
+    @asyncio.coroutine
+    def _update(self):
+        if not self.watch:
+            items = yield From(self.client.query_formation(
+                    self.form_name, self.factory))
+            self._cache = dict(items)
+            return
+        etag, raw = yield From(self.client.poll_formation(
+                self.form_name, self._etag))
+        if raw is None:
+            return
+        self._etag = etag
+        for k in self._raw:
+            if k not in raw:
+                del self._cache[k]
+        for k, d in raw.items():
+            if self._raw.get(k) != d:
+                self._cache[k] = self.factory(d)
+        self._raw = raw
+
+    @asyncio.coroutine
+    def _loop(self):
+        while True:
+            yield From(asyncio.sleep(self.interval, loop=self.client.loop))
+            try:
+                yield From(self._update())
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                self.log.exception("could not update formation cache")
+
+    def query(self):
+        """Return all instances and their names."""
+        return dict(self._cache)
+
+
+class Resolver(CachedResolver):
+    """Resolver that answers from in-memory formation snapshots,
+    fetching them from the registry without blocking the event loop.
+
+    Concurrent resolutions that need the same formation share a
+    single fetch.  See :class:`gilliam.service_registry.CachedResolver`
+    for the meaning of the arguments.
+    """
+
+    def __init__(self, client, search_domain='', ttl=5, stale=30,
+                 clock=time, balancer=None, negative_ttl=1, outliers=None):
+        CachedResolver.__init__(self, client, search_domain, ttl, stale,
+                                clock, balancer, negative_ttl, outliers)
+        self._inflight = {}
+
+    @asyncio.coroutine
+    def resolve_url(self, url):
+        """Given a URL, return a resolved url."""
+        u = urlsplit(url)
+        host, port = yield From(self.resolve_host_port(u.hostname,
+                                                       int(u.port)))
+        raise Return(urlunsplit((u.scheme, '%s:%d' % (host, port),
+                                 u.path, u.query, u.fragment)))
+
+    @asyncio.coroutine
+    def resolve_host_port(self, host, port):
+        """Given a host and a port, return resolved host and port."""
+        formation = self._formation_of(host)
+        if formation is not None:
+            yield From(self._prepare(formation))
+        raise Return(CachedResolver.resolve_host_port(self, host, port))
+
+    def _formation_of(self, host):
+        """Return the formation that `host` would be resolved in."""
+        if '.' in host and not host.endswith(".service"):
+            return None
+        parts = host.split('.')
+        if len(parts) == 1:
+            return self.search_domain[0] or None
+        elif len(parts) == 3:
+            return parts[1]
+        elif len(parts) == 4:
+            return parts[2]
+
+    @asyncio.coroutine
+    def _prepare(self, formation):
+        """Make sure there is a usable snapshot of `formation`."""
+        snapshot = self._snapshots.get(formation)
+        if snapshot is not None:
+            age = self.clock.time() - snapshot.fetched_at
+            if age < self.ttl:
+                return
+            elif age < self.ttl + self.stale:
+                self._refresh(formation)
+                return
+        yield From(asyncio.shield(self._refresh(formation),
+                                  loop=self.client.loop))
+
+    @asyncio.coroutine
+    def _fetch(self, formation):
+        previous = self._snapshots.get(formation)
+        etag, instances = yield From(self.client.poll_formation(
+                formation, previous.etag if previous is not None else None))
+        if instances is None:
+            previous.fetched_at = self.clock.time()
+            return
+        self._snapshots[formation] = _FormationSnapshot(
+            instances.values(), etag, self.clock.time())
+
+    def _refresh(self, formation):
+        task = self._inflight.get(formation)
+        if task is None:
+            task = asyncio.ensure_future(self._fetch(formation),
+                                         loop=self.client.loop)
+            task.add_done_callback(
+                lambda t: self._refreshed(formation, t))
+            self._inflight[formation] = task
+        return task
+
+    def _refreshed(self, formation, task):
+        del self._inflight[formation]
+        if not task.cancelled() and task.exception() is not None:
+            self.log.error("could not refresh formation %s: %s" % (
+                    formation, task.exception()))
+
+    def _snapshot(self, formation):
+        snapshot = self._snapshots.get(formation)
+        if snapshot is None:
+            snapshot = _FormationSnapshot([], None, 0)
+        return snapshot
+
+
+class ServiceRegistryClient(object):
+    """Asyncio client for the service registry cluster."""
+
+    def __init__(self, clock, cluster_nodes=None, loop=None):
+        self.clock = clock
+        self.loop = loop or asyncio.get_event_loop()
+        self.http = HTTPClient(loop=self.loop)
+        self.cluster_nodes = []
+        if cluster_nodes is None:
+            cluster_nodes = os.getenv(
+                'GILLIAM_SERVICE_REGISTRY', '').split(',')
+        for cluster_node in cluster_nodes:
+            if not cluster_node.startswith('http://'):
+                cluster_node = 'http://%s' % (cluster_node,)
+            self.cluster_nodes.append(cluster_node)
+        random.shuffle(self.cluster_nodes)
+        self.breaker = CircuitBreakerSet(clock.time, logging.getLogger(
+                'service-discovery-client'))
+        self.breaker.handle_error(TransportError)
+        self.breaker.handle_error(ServerError)
+
+    def close(self):
+        self.http.close()
+
+    @asyncio.coroutine
+    def _request(self, method, uri, **kwargs):
+        """Issue a request to SOME of the nodes in the cluster."""
+        for node in self.cluster_nodes:
+            try:
+                with self.breaker.context(node):
+                    response = yield From(self.http.request(
+                            method, urljoin(node, uri), **kwargs))
+                    if response.status_code >= 500:
+                        raise ServerError('%s: %d' % (
+                                node, response.status_code))
+            except CircuitOpenError:
+                continue
+            raise Return(response)
+        else:
+            raise Exception("NO MACHIEN TO TALK TOOO")
+
+    def register(self, form_name, service, instance_name, data,
+                 lease_only=False):
+        """Register an instance with a formation.
+
+        Returns a registration that is kept alive by a task until
+        stopped.
+        """
+        return _Registration(self, form_name, service, instance_name, data,
+                             lease_only=lease_only).start()
+
+    def build_announcement(self, formation, service, instance,
+                           ports={}, **kwargs):
+        announcement = {
+            'formation': formation, 'service': service,
+            'instance': instance, 'ports': ports.copy(),
+            }
+        announcement.update(kwargs)
+        return announcement
+
+    @asyncio.coroutine
+    def query_formation(self, form_name, factory=dict):
+        """Query all instances of a formation.
+
+        Returns a list of (instance name, data) for each instance.
+        """
+        response = yield From(self._request('GET', '/%s' % (form_name,)))
+        response.raise_for_status()
+        raise Return([(key, factory(data))
+                      for (key, data) in response.json().items()])
+
+    @asyncio.coroutine
+    def poll_formation(self, form_name, etag=None):
+        """Conditionally query all instances of a formation.  See
+        :meth:`gilliam.service_registry.ServiceRegistryClient.poll_formation`.
+        """
+        headers = {}
+        if etag is not None:
+            headers['If-None-Match'] = etag
+        response = yield From(self._request('GET', '/%s' % (form_name,),
+                                            headers=headers))
+        if response.status_code == 304:
+            raise Return((etag, None))
+        response.raise_for_status()
+        raise Return((response.headers.get('etag'), response.json()))
+
+    @asyncio.coroutine
+    def formation_cache(self, form_name, factory=dict, interval=15,
+                        watch=False):
+        """Return a cache for a specific formation that will be kept
+        up to date until stopped.
+        """
+        cache = yield From(_FormationCache(self, form_name, factory,
+                                           interval, watch).start())
+        raise Return(cache)
+
+
+def make_client(loop=None):
+    """Construct an asyncio service registry client."""
+    return ServiceRegistryClient(
+        time, os.getenv('GILLIAM_SERVICE_REGISTRY_NODES', '').split(','),
+        loop=loop)
@@ -0,0 +1,190 @@
+# Copyright 2013 Johan Rydberg.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Strategies for picking one of several instances of a service.
+
+An endpoint is a `(host, port)` tuple.  The resolver asks its
+balancer to `choose` one endpoint out of a list of alternatives, and
+the :class:`ResolveAdapter <gilliam.adapter.ResolveAdapter>` reports
+back when requests to an endpoint are `started` and `finished`.
+"""
+
+import itertools
+import math
+import random
+import threading
+import time
+
+
+class Balancer(object):
+    """Base class for balancers.  Keeps track of the number of
+    outstanding requests per endpoint.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.outstanding = {}
+
+    def choose(self, endpoints):
+        """Return one of `endpoints`."""
+        raise NotImplementedError()
+
+    def started(self, endpoint):
+        """A request to `endpoint` has been started."""
+        with self._lock:
+            self.outstanding[endpoint] = self.outstanding.get(endpoint, 0) + 1
+
+    def finished(self, endpoint, elapsed, failed=False):
+        """A request to `endpoint` has finished after `elapsed`
+        seconds.
+        """
+        with self._lock:
+            count = self.outstanding.get(endpoint, 0) - 1
+            if count > 0:
+                self.outstanding[endpoint] = count
+            else:
+                self.outstanding.pop(endpoint, None)
+
+
+class RandomBalancer(Balancer):
+    """Pick an endpoint at random."""
+
+    def choose(self, endpoints):
+        return random.choice(endpoints)
+
+
+class RoundRobinBalancer(Balancer):
+    """Cycle through the endpoints."""
+
+    def __init__(self):
+        Balancer.__init__(self)
+        self._counter = itertools.count()
+
+    def choose(self, endpoints):
+        return endpoints[next(self._counter) % len(endpoints)]
+
+
+class LeastOutstandingBalancer(Balancer):
+    """Pick the endpoint with the fewest outstanding requests.  Ties
+    are broken at random.
+    """
+
+    def choose(self, endpoints):
+        outstanding = self.outstanding
+        return min(endpoints, key=lambda endpoint: (
+                outstanding.get(endpoint, 0), random.random()))
+
+
+class PowerOfTwoBalancer(Balancer):
+    """Pick two endpoints at random and use the one with the fewest
+    outstanding requests.
+    """
+
+    def _load(self, endpoint):
+        return self.outstanding.get(endpoint, 0)
+
+    def choose(self, endpoints):
+        if len(endpoints) < 2:
+            return endpoints[0]
+        a, b = random.sample(endpoints, 2)
+        return a if self._load(a) <= self._load(b) else b
+
+
+class EWMABalancer(PowerOfTwoBalancer):
+    """Power-of-two-choices over a latency-weighted load.
+
+    The load of an endpoint is an exponentially weighted moving
+    average of its response times, multiplied by the number of
+    outstanding requests plus one.  Samples decay with a time constant
+    of `decay` seconds.  Endpoints that have not yet been measured get
+    a latency of `default` seconds.  A failed request counts as having
+    taken at least `failure_penalty` seconds, so that an endpoint that
+    fails fast does not attract more requests.
+    """
+
+    def __init__(self, decay=10.0, default=0.1, failure_penalty=1.0,
+                 clock=time):
+        PowerOfTwoBalancer.__init__(self)
+        self.decay = decay
+        self.default = default
+        self.failure_penalty = failure_penalty
+        self.clock = clock
+        self._latency = {}
+
+    def _load(self, endpoint):
+        latency, _ = self._latency.get(endpoint, (self.default, None))
+        return latency * (self.outstanding.get(endpoint, 0) + 1)
+
+    def finished(self, endpoint, elapsed, failed=False):
+        PowerOfTwoBalancer.finished(self, endpoint, elapsed, failed)
+        if failed:
+            elapsed = max(elapsed, self.failure_penalty)
+        now = self.clock.time()
+        with self._lock:
+            previous = self._latency.get(endpoint)
+            if previous is None:
+                latency = elapsed
+            else:
+                weight = math.exp(-(now - previous[1]) / self.decay)
+                latency = previous[0] * weight + elapsed * (1 - weight)
+            self._latency[endpoint] = (latency, now)
+
+
+class OutlierDetector(object):
+    """Keeps track of endpoints that fail to accept connections.
+
+    An endpoint that fails `threshold` times in a row is ejected for
+    `cooldown` seconds, during which it is not handed out by the
+    resolver.
+    """
+
+    def __init__(self, threshold=1, cooldown=10, clock=time):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._failures = {}
+        self._ejected = {}
+
+    def failed(self, endpoint):
+        """A connection to `endpoint` failed."""
+        with self._lock:
+            failures = self._failures.get(endpoint, 0) + 1
+            if failures >= self.threshold:
+                self._failures.pop(endpoint, None)
+                self._ejected[endpoint] = self.clock.time() + self.cooldown
+            else:
+                self._failures[endpoint] = failures
+
+    def succeeded(self, endpoint):
+        """A request to `endpoint` went through."""
+        if endpoint in self._failures:
+            with self._lock:
+                self._failures.pop(endpoint, None)
+
+    def filter(self, endpoints):
+        """Return the endpoints that are not ejected.  If all of them
+        are, return all of them rather than none.
+        """
+        if not self._ejected:
+            return endpoints
+        now = self.clock.time()
+        with self._lock:
+            for endpoint, until in self._ejected.items():
+                if until <= now:
+                    del self._ejected[endpoint]
+            ejected = self._ejected
+            available = [endpoint for endpoint in endpoints
+                         if endpoint not in ejected]
+        return available or endpoints
@@ -12,109 +12,509 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import collections
+import heapq
+import itertools
 import json
+import logging
+import Queue
+import socket
 import threading
 import time
 
+from concurrent import futures
+
 from .packages import websocket
-from .util import thread
+from .streams import AttachMultiplexer, OutputPump, read_chunks
+from .util import iter_lines, thread
 from . import errors
 
 
+class _Watch(object):
+    """The processes waiting for status changes of a process."""
+
+    def __init__(self, url, delay):
+        self.url = url
+        self.delay = delay
+        self.waiters = []
+        # the sequence number of the current entry in the queue.
+        self.seq = None
+
+
+class _StatusTracker(object):
+    """Polls the status of many processes from a single thread.
+
+    Each process is polled with exponential backoff from
+    `min_interval` up to `interval` seconds, and no more than
+    `max_rate` polls are made per second in total.  Waiters on the
+    same process share polls.  A poll that takes longer than `timeout`
+    seconds is given up on, so that an executor that does not answer
+    does not hold up polls of other processes.
+    """
+
+    def __init__(self, client, interval=3, min_interval=0.05, max_rate=50,
+                 timeout=10, clock=time):
+        self.log = logging.getLogger('{0}.tracker'.format(__name__))
+        self.client = client
+        self.interval = interval
+        self.min_interval = min_interval
+        self.max_rate = max_rate
+        self.timeout = timeout
+        self.clock = clock
+        self._watches = {}
+        self._queue = []
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._thread = None
+
+    def watch(self, url, done, value=lambda data: data):
+        """Return a future that is resolved with `value` of the status
+        of the process at `url` once `done` returns true for it.
+        """
+        future = futures.Future()
+        with self._cond:
+            w = self._watches.get(url)
+            if w is None:
+                w = self._watches[url] = _Watch(url, self.min_interval)
+            # poll right away; an entry already in the queue may be
+            # up to `interval` seconds away and is left to go stale.
+            w.delay = self.min_interval
+            self._schedule(w, self.clock.time())
+            w.waiters.append((done, value, future))
+            if self._thread is None:
+                self._thread = thread(self._loop)
+            self._cond.notify()
+        return future
+
+    def _schedule(self, w, when):
+        w.seq = next(self._seq)
+        heapq.heappush(self._queue, (when, w.seq, w))
+
+    def _next(self):
+        with self._cond:
+            while True:
+                if not self._queue:
+                    self._cond.wait()
+                    continue
+                delay = self._queue[0][0] - self.clock.time()
+                if delay > 0:
+                    self._cond.wait(delay)
+                    continue
+                _, seq, w = heapq.heappop(self._queue)
+                if seq == w.seq:
+                    return w
+
+    def _check(self, w):
+        with self._cond:
+            waiters = [waiter for waiter in w.waiters
+                       if not waiter[2].done()]
+        if not waiters:
+            return
+        try:
+            response = self.client.get(w.url, timeout=self.timeout)
+            response.raise_for_status()
+            data = response.json()
+        except Exception, err:
+            self.log.debug("could not poll %s: %s" % (w.url, err))
+            data, failure = None, err
+        for done, value, future in waiters:
+            if data is not None and not done(data):
+                continue
+            if not future.set_running_or_notify_cancel():
+                continue
+            if data is None:
+                future.set_exception(failure)
+            else:
+                future.set_result(value(data))
+
+    def _loop(self):
+        while True:
+            w = self._next()
+            t0 = self.clock.time()
+            self._check(w)
+            with self._cond:
+                w.waiters = [waiter for waiter in w.waiters
+                             if not waiter[2].done()]
+                if w.waiters:
+                    self._schedule(w, self.clock.time() + w.delay)
+                    w.delay = min(w.delay * 2, self.interval)
+                else:
+                    del self._watches[w.url]
+            pause = 1.0 / self.max_rate - (self.clock.time() - t0)
+            if pause > 0:
+                self.clock.sleep(pause)
+
+
+def _exited(data):
+    return data['status'] is not None
+
+
+def _latest_progress(statuses, interval, clock=time):
+    """Collapse the progress messages of each layer in a stream of
+    push statuses, passing on only the latest of them at most once
+    every `interval` seconds.
+    """
+    pending = collections.OrderedDict()
+    flushed = clock.time()
+    for status in statuses:
+        if status.get('progressDetail') and 'id' in status:
+            pending[status['id']] = status
+        else:
+            pending.pop(status.get('id'), None)
+            yield status
+        if pending and clock.time() - flushed >= interval:
+            for progress in pending.values():
+                yield progress
+            pending.clear()
+            flushed = clock.time()
+    for progress in pending.values():
+        yield progress
+
+
+class _ImagePushes(object):
+    """The status messages of images being pushed concurrently,
+    merged into one iterator of `(image, status)`.
+
+    A push that fails yields the error that ended it as its status.
+    """
+
+    def __init__(self, pool, executor, images, auth, throttle, clock=time):
+        self.clock = clock
+        self.started = clock.time()
+        self._queue = Queue.Queue()
+        self._progress = {}
+        self._remaining = len(images)
+        for image in images:
+            pool.submit(self._push, executor, image, auth, throttle)
+
+    def _push(self, executor, image, auth, throttle):
+        try:
+            for status in executor.push_image(image, auth, throttle):
+                self._queue.put((image, status))
+        except Exception, err:
+            self._queue.put((image, err))
+        finally:
+            self._queue.put((image, None))
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        while self._remaining:
+            image, status = self._queue.get()
+            if status is None:
+                self._remaining -= 1
+                continue
+            if isinstance(status, dict):
+                detail = status.get('progressDetail') or {}
+                if 'current' in detail and 'id' in status:
+                    self._progress[image, status['id']] = detail['current']
+            return image, status
+        raise StopIteration
+
+    @property
+    def bytes_pushed(self):
+        """Bytes pushed so far, according to the progress messages
+        seen, across all images.
+        """
+        return sum(self._progress.values())
+
+    def throughput(self):
+        """Bytes pushed per second across all images so far."""
+        elapsed = self.clock.time() - self.started
+        return self.bytes_pushed / elapsed if elapsed > 0 else 0.0
+
+
 class _RunningProcess(object):
     """A running process on an executor."""
 
-    def __init__(self, client, location, process, clock=time):
+    def __init__(self, client, location, process, clock=time, tracker=None,
+                 multiplexer=None):
+        self.log = logging.getLogger('{0}.process'.format(__name__))
         self.client = client
         self._process = process
         self._url = location
         self.status = None
         self._clock = clock
+        self._tracker = tracker
+        self._multiplexer = multiplexer
 
-    def wait(self, timeout=None, interval=3):
+    def _poll(self, done, timeout=None, interval=3, min_interval=0.05,
+              watch=False):
+        """Poll the executor for the status of the process until
+        `done` returns true for it, or `timeout` seconds has passed.
+
+        Polls start out `min_interval` seconds apart and back off
+        exponentially up to `interval` seconds.  If `watch` is true,
+        the executor is asked to hold each request until the status of
+        the process changes.
+
+        :returns: The last status, or `None` on timeout.
+        """
+        deadline = self._clock.time() + timeout if timeout else None
+        delay = min_interval
+        while True:
+            remaining = None
+            if deadline is not None:
+                remaining = deadline - self._clock.time()
+                if remaining <= 0:
+                    return None
+            params, request_timeout = {}, None
+            if watch:
+                params['wait'] = '%d' % (min(remaining or interval,
+                                             interval) * 1000,)
+                request_timeout = (remaining or interval) + interval
+            response = self.client.get(self._url, params=params,
+                                       timeout=request_timeout)
+            response.raise_for_status()
+            data = response.json()
+            if done(data):
+                return data
+            self._clock.sleep(delay if remaining is None
+                              else min(delay, remaining))
+            delay = min(delay * 2, interval)
+
+    def wait(self, timeout=None, interval=3, min_interval=0.05,
+             watch=False):
         """Wait for the process to finish and return its exit code, or
         `None` if timeout.
 
         :params timeout: The number of seconds to wait for the process
             to exit.
-        :params interval: How often to poll the executor for status
-            changes.  Defaults to 3 seconds.
+        :params interval: The longest time between polls of the
+            executor for status changes.  Defaults to 3 seconds.
+        :params min_interval: The time between the first polls, which
+            is then doubled for every poll.  Defaults to 50 ms.
+        :params watch: Ask the executor to hold each poll until the
+            status of the process changes, which it is free to ignore.
+
+        Processes started through :class:`ExecutorClient` are polled
+        by the status tracker of the client, unless `watch` is given,
+        and `interval` and `min_interval` are then not used.
 
         :returns: The exit code of the process or `None` if the process
             didn't exit within the specified timeout.
         """
-        def _wait(e):
-            while self.status is None and not e.is_set():
-                response = self.client.get(self._url)
-                data = response.json()
-                self.status = data['status']
-                self._clock.sleep(interval)
-                
-        e = threading.Event()
-        t = threading.Thread(target=_wait, args=(e,))
-        t.daemon = True
-        t.start()
-        t.join(timeout or 2**31)
-        e.set()
+        if self.status is not None:
+            return self.status
+        if self._tracker is not None and not watch:
+            future = self.result_future()
+            try:
+                return future.result(timeout or None)
+            except futures.TimeoutError:
+                future.cancel()
+                return None
+        data = self._poll(_exited, timeout, interval, min_interval, watch)
+        if data is not None:
+            self.status = data['status']
         return self.status
 
-    def attach(self, input, output, replay=False):
-        """Attach to the input and output streams of the process.
+    def result_future(self):
+        """Return a future that is resolved with the exit code of the
+        process once it exits.
 
-        Waits for the process to enter state `running` before
-        attaching.
+        Only available for processes started through
+        :class:`ExecutorClient`.
+        """
+        future = self._tracker.watch(self._url, _exited,
+                                     lambda data: data['status'])
 
-        .. note::
+        def exited(future):
+            if not future.cancelled() and future.exception() is None:
+                self.status = future.result()
+        future.add_done_callback(exited)
+        return future
 
-           This method call does **not** return, so call it in a
-           thread.
+    def state_future(self, *states):
+        """Return a future that is resolved with the state of the
+        process once it enters one of `states`.
 
-        :params input: Read from this `file`-like object and pass it
-            to stdin of the process.
+        Only available for processes started through
+        :class:`ExecutorClient`.
+        """
+        return self._tracker.watch(self._url,
+                                   lambda data: data['state'] in states,
+                                   lambda data: data['state'])
 
-        :param output: Write output from the process to this
-            `file`-like object.
+    def _connect(self, replay, offset=0):
+        """Wait for the process to enter state `running` and open a
+        websocket to its streams.
 
-        :param replay: If `True`, replay output data that has been
-            captured earlier.
+        If `replay` is true, captured output is replayed from `offset`
+        bytes in.  Executors that do not echo the offset back in an
+        `X-Replay-Offset` header replay everything, so the returned
+        number of bytes has to be skipped by the caller.
+
+        :returns: `(websocket, bytes to skip)`
         """
         self.wait_for_state('running')
 
         params = {}
         if replay:
             params['logs'] = 1
+            if offset:
+                params['offset'] = offset
 
         url = '%s/attach' % (self._url,)
         url = url.replace('http://', 'ws://').replace('https://', 'wss://')
 
         resp = self.client.get(url, params=params)
         resp.raise_for_status()
-        ws = resp.websocket
+        skip = 0
+        if replay and offset:
+            skip = offset - int(resp.headers.get('x-replay-offset', 0))
+        return resp.websocket, max(skip, 0)
 
-        def send():
+    def _reconnect(self, replay, offset, attempts, interval):
+        """Try to connect again after the connection was lost, backing
+        off exponentially up to `interval` seconds between attempts.
+
+        :returns: `(websocket, bytes to skip)`, or `(None, 0)` if the
+            process is no longer running or all attempts failed.
+        """
+        delay = 0.05
+        for _ in range(attempts):
+            self._clock.sleep(delay)
+            delay = min(delay * 2, interval)
             try:
-                for data in input:
-                    ws.send_binary(data)
-            except websocket.WebSocketConnectionClosedException:
-                pass
+                response = self.client.get(self._url)
+                response.raise_for_status()
+                if response.json()['state'] != 'running':
+                    break
+                return self._connect(replay, offset)
+            except Exception, err:
+                self.log.debug("could not reconnect to %s: %s" % (
+                        self._url, err))
+        return None, 0
+
+    def attach(self, input, output, replay=False, chunk_size=64 * 1024,
+               coalesce=0.005, output_buffer=None, flush=0,
+               overflow='block', reconnect=0, reconnect_interval=3):
+        """Attach to the input and output streams of the process.
 
-        def recv():
+        Waits for the process to enter state `running` before
+        attaching.
+
+        .. note::
+
+           This method call does **not** return, so call it in a
+           thread.
+
+        :params input: Read from this `file`-like object and pass it
+            to stdin of the process.  Any iterable of strings will do.
+
+        :param output: Write output from the process to this
+            `file`-like object.
+
+        :param replay: If `True`, replay output data that has been
+            captured earlier.
+
+        :param chunk_size: The most data to read from `input` and send
+            to the process at a time.
+
+        :param coalesce: For how long, in seconds, to wait for more
+            input after a short read before sending it.  See
+            :func:`gilliam.streams.read_chunks`.
+
+        :param output_buffer: If given, write to `output` from a
+            separate thread, buffering up to this many bytes so that a
+            slow `output` does not stall the connection.  `flush` and
+            `overflow` decide when `output` is flushed and what to do
+            when the buffer is full.  See
+            :class:`gilliam.streams.OutputPump`.
+
+        :param reconnect: How many times in a row to try to connect
+            again if the connection is lost while the process is still
+            running, backing off exponentially up to
+            `reconnect_interval` seconds between attempts.  With
+            `replay`, output resumes where the lost connection left
+            off; without it, output produced while disconnected is
+            lost.
+        """
+        ws, skip = self._connect(replay)
+        cond = threading.Condition()
+        current = [ws]
+
+        def send():
+            ws = current[0]
+            for data in read_chunks(input, chunk_size, coalesce):
+                while ws is not None:
+                    try:
+                        ws.send_binary(data)
+                        break
+                    except (websocket.WebSocketConnectionClosedException,
+                            socket.error):
+                        with cond:
+                            while current[0] is ws:
+                                cond.wait()
+                            ws = current[0]
+                if ws is None:
+                    return
+
+        if output_buffer is not None:
+            pump = OutputPump(output, output_buffer, flush, overflow)
+            write = pump.put
+        else:
+            pump, write = None, output.write
+
+        def switch(ws):
+            with cond:
+                current[0] = ws
+                cond.notify_all()
+
+        def recv(ws, skip):
+            received = 0
             try:
                 while True:
-                    data = ws.recv()
+                    try:
+                        data = ws.recv()
+                    except (websocket.WebSocketConnectionClosedException,
+                            socket.error):
+                        ws, skip = self._reconnect(replay, received,
+                                                   reconnect,
+                                                   reconnect_interval)
+                        if ws is None:
+                            break
+                        switch(ws)
+                        continue
                     if not data:
                         break
-                    else:
-                        output.write(data)
-            except websocket.WebSocketConnectionClosedException:
-                pass
-        
+                    if skip:
+                        n = min(skip, len(data))
+                        data, skip = data[n:], skip - n
+                        if not data:
+                            continue
+                    received += len(data)
+                    write(data)
+            finally:
+                switch(None)
+                if pump is not None:
+                    pump.close()
+
         sender = thread(send)
-        recver = thread(recv)
+        recver = thread(recv, ws, skip)
 
         for t in (sender, recver):
             t.join()
 
+    def attach_output(self, output, replay=False):
+        """Attach to the output stream of the process without
+        starting any threads.
+
+        Waits for the process to enter state `running`, and then
+        leaves the connection to the multiplexer of the client, which
+        writes output to `output` from its own thread.  See
+        :class:`gilliam.streams.AttachMultiplexer`.
+
+        Only available for processes started through
+        :class:`ExecutorClient`.
+
+        :returns: A future that is resolved when the output stream is
+            closed.  Cancel it to detach.
+        """
+        ws, _ = self._connect(replay)
+        return self._multiplexer.add(ws, output)
+
     def commit(self, repository, tag):
         """Commit the container into an image.
 
@@ -140,14 +540,10 @@ class _RunningProcess(object):
         :params states: The expected state.
         :returns: The state.
         """
-        while True:
-            response = self.client.get(self._url)
-            response.raise_for_status()
-            data = response.json()
-            if data['state'] in states:
-                return data['state']
-            else:
-                self._clock.sleep(3)
+        if self._tracker is not None:
+            return self.state_future(*states).result()
+        data = self._poll(lambda data: data['state'] in states)
+        return data['state']
 
     def resize_tty(self, width, height):
         """Set size of process TTY to `width` x `height`."""
@@ -158,11 +554,24 @@ class _RunningProcess(object):
 
 
 class ExecutorClient(object):
-    """Client interface for the executor."""
+    """Client interface for the executor.
 
-    def __init__(self, client, host='api.executor.service', port=9000):
+    The status of all processes started through the client is polled
+    by a single status tracker, which makes at most `max_poll_rate`
+    polls per second.  Processes started with `run_async` are started
+    by a pool of at most `max_workers` threads.  Output of processes
+    attached to with `attach_output` is moved by a single thread.
+    """
+
+    def __init__(self, client, host='api.executor.service', port=9000,
+                 max_poll_rate=50, max_workers=8):
         self.client = client
         self.base_url = 'http://%s:%d' % (host, port)
+        self.tracker = _StatusTracker(client, max_rate=max_poll_rate)
+        self.multiplexer = AttachMultiplexer()
+        self.max_workers = max_workers
+        self._pool = None
+        self._pool_lock = threading.Lock()
 
     def _url(self, fmt, *args):
         path_info = fmt % args
@@ -174,7 +583,7 @@ class ExecutorClient(object):
         else:
             return errors.InternalServerError(detail['message'])
 
-    def push_image(self, image, auth={}):
+    def push_image(self, image, auth={}, throttle=None):
         """Push an image to its registry.
 
         Which registry is determined based on `image`; if it contains
@@ -192,6 +601,10 @@ class ExecutorClient(object):
         :param auth: Credentials to authenticate with against the
             registry.
 
+        :param throttle: If given, only yield the latest progress of
+            each layer, at most once every `throttle` seconds.  Other
+            status messages are yielded as they arrive.
+
         :raises: PermissionError, InternalServerError, GilliamError
 
         :returns: An iterator that yields status messages while the
@@ -206,14 +619,52 @@ class ExecutorClient(object):
         except Exception, err:
             errors.convert_error(err)
 
-        ITER_CHUNK_SIZE = 1
-        for text in response.iter_lines(ITER_CHUNK_SIZE):
-            status = json.loads(text)
+        # the executor streams status messages with chunked encoding,
+        # which requests >= 2.9 passes on chunk by chunk as it arrives
+        # rather than waiting for a full read.
+        ITER_CHUNK_SIZE = 64 * 1024
+        statuses = (json.loads(text) for text in iter_lines(
+                response.iter_content(ITER_CHUNK_SIZE)))
+        if throttle is not None:
+            statuses = _latest_progress(statuses, throttle)
+        for status in statuses:
             if 'error' in status:
                 raise self._convert_image_error(
                     status['errorDetail'])
             yield status
 
+    def push_images(self, images, auth={}, throttle=None,
+                    max_concurrency=None):
+        """Push several images at the same time.
+
+        Images are pushed by the thread pool of the client, or by a
+        pool of `max_concurrency` threads if given.  `auth` and
+        `throttle` are passed on to :meth:`push_image`.
+
+        .. code-block: python
+
+           >>> pushes = executor.push_images(['name/a', 'name/b'])
+           >>> for image, status in pushes:
+           ...     print image, status
+           ...
+           >>> print pushes.throughput()
+
+        :returns: An iterator that yields `(image, status)` for the
+            status messages of all images as they arrive.  If pushing
+            an image fails, the error is yielded as its status.  The
+            `bytes_pushed` attribute and `throughput()` method of the
+            iterator report progress across all images.
+        """
+        images = list(images)
+        if max_concurrency is None:
+            return _ImagePushes(self._executor(), self, images, auth,
+                                throttle)
+        pool = futures.ThreadPoolExecutor(max_concurrency)
+        try:
+            return _ImagePushes(pool, self, images, auth, throttle)
+        finally:
+            pool.shutdown(wait=False)
+
     def _run(self, formation, image, env, command, tty):
         request = {'formation': formation, 'image': image,
                    'env': env, 'command': command, 'tty': tty}
@@ -229,4 +680,51 @@ class ExecutorClient(object):
     def run(self, formation, image, env, command, tty=False):
         location, response = self._run(
             formation, image, env, command, tty)
-        return _RunningProcess(self.client, location, response)
+        return _RunningProcess(self.client, location, response,
+                               tracker=self.tracker,
+                               multiplexer=self.multiplexer)
+
+    def _executor(self):
+        with self._pool_lock:
+            if self._pool is None:
+                self._pool = futures.ThreadPoolExecutor(self.max_workers)
+            return self._pool
+
+    def run_async(self, formation, image, env, command, tty=False):
+        """Start a process without waiting for the executor to answer.
+
+        Returns a future that is resolved with the running process.
+        Use :meth:`_RunningProcess.result_future` of the process to
+        wait for it to exit.
+        """
+        return self._executor().submit(self.run, formation, image, env,
+                                       command, tty)
+
+    def run_many(self, specs, max_concurrency=None):
+        """Start a batch of processes.
+
+        Processes are started concurrently by the thread pool of the
+        client, or by a pool of `max_concurrency` threads if given.
+        Make sure that the connection pool of the HTTP client is at
+        least that large, or connections will not be reused.
+
+        :param specs: `(formation, image, env, command)` or
+            `(formation, image, env, command, tty)` tuples.
+
+        :returns: A list that for each spec, in order, holds either the
+            running process or the error that starting it raised.
+        """
+        if max_concurrency is None:
+            return self._run_many(self._executor(), specs)
+        with futures.ThreadPoolExecutor(max_concurrency) as pool:
+            return self._run_many(pool, specs)
+
+    def _run_many(self, pool, specs):
+        pending = [pool.submit(self.run, *spec) for spec in specs]
+        results = []
+        for future in pending:
+            try:
+                results.append(future.result())
+            except Exception, err:
+                results.append(err)
+        return results
@@ -35,7 +35,6 @@ except ImportError:
 
 from urlparse import urlparse
 import os
-import array
 import struct
 import uuid
 import hashlib
@@ -59,6 +58,11 @@ Please see http://tools.ietf.org/html/rfc6455 for protocol.
 # websocket supported version.
 VERSION = 13
 
+# size of the send and receive buffers of each connection.  Frames
+# larger than the send buffer are sent from a buffer of their own.
+SEND_BUFFER_SIZE = 64 * 1024
+RECV_BUFFER_SIZE = 64 * 1024
+
 # closing frame status codes.
 STATUS_NORMAL = 1000
 STATUS_GOING_AWAY = 1001
@@ -75,6 +79,16 @@ STATUS_TLS_HANDSHAKE_ERROR = 1015
 
 logger = logging.getLogger()
 
+# translation tables that xor every byte with a key byte, by key byte.
+_xor_tables = {}
+
+
+def _xor_table(key):
+    table = _xor_tables.get(key)
+    if table is None:
+        table = _xor_tables[key] = str(bytearray(i ^ key for i in range(256)))
+    return table
+
 
 class WebSocketException(Exception):
     """
@@ -194,10 +208,12 @@ def create_connection(url, timeout=None, **options):
 
     options: current support option is only "header".
              if you set header as dict value, the custom HTTP headers are added.
+             "max_message_size" limits the size of received messages.
     """
     sockopt = options.get("sockopt", [])
     sslopt = options.get("sslopt", {})
-    websock = WebSocket(sockopt=sockopt, sslopt=sslopt)
+    websock = WebSocket(sockopt=sockopt, sslopt=sslopt,
+                        max_message_size=options.get("max_message_size"))
     websock.settimeout(timeout if timeout is not None else default_timeout)
     websock.connect(url, **options)
     return websock
@@ -295,6 +311,18 @@ class ABNF(object):
         """
         format this object to string(byte array) to send data to server.
         """
+        frame_header = self.format_header()
+        if not self.mask:
+            return frame_header + self.data
+        else:
+            mask_key = self.get_mask_key(4)
+            return frame_header + self._get_masked(mask_key)
+
+    def format_header(self):
+        """
+        format the header of this frame, up to but not including the
+        mask key, to string(byte array).
+        """
         if any(x not in (0, 1) for x in [self.fin, self.rsv1, self.rsv2, self.rsv3]):
             raise ValueError("not 0 or 1")
         if self.opcode not in ABNF.OPCODES:
@@ -314,16 +342,10 @@ class ABNF(object):
         else:
             frame_header += chr(self.mask << 7 | 0x7f)
             frame_header += struct.pack("!Q", length)
-
-        if not self.mask:
-            return frame_header + self.data
-        else:
-            mask_key = self.get_mask_key(4)
-            return frame_header + self._get_masked(mask_key)
+        return frame_header
 
     def _get_masked(self, mask_key):
-        s = ABNF.mask(mask_key, self.data)
-        return mask_key + "".join(s)
+        return mask_key + ABNF.mask(mask_key, self.data)
 
     @staticmethod
     def mask(mask_key, data):
@@ -334,11 +356,25 @@ class ABNF(object):
 
         data: data to mask/unmask.
         """
-        _m = array.array("B", mask_key)
-        _d = array.array("B", data)
-        for i in xrange(len(_d)):
-            _d[i] ^= _m[i % 4]
-        return _d.tostring()
+        masked = bytearray(len(data))
+        ABNF.mask_into(mask_key, data, masked)
+        return str(masked)
+
+    @staticmethod
+    def mask_into(mask_key, data, buf, offset=0):
+        """
+        mask or unmask data into bytearray buf, starting at offset.
+
+        mask_key: 4 byte string(byte).
+
+        data: data to mask/unmask.
+        """
+        # every 4th byte is xored with the same key byte, so translate
+        # each of the 4 strides in one go rather than byte by byte.
+        end = offset + len(data)
+        for i in xrange(4):
+            buf[offset + i:end:4] = data[i::4].translate(
+                _xor_table(ord(mask_key[i])))
 
 
 class WebSocket(object):
@@ -364,9 +400,12 @@ class WebSocket(object):
     sockopt: values for socket.setsockopt.
         sockopt must be tuple and each element is argument of sock.setscokopt.
     sslopt: dict object for ssl socket option.
+    max_message_size: the largest message, in bytes, to receive.
+        None for no limit.
     """
 
-    def __init__(self, get_mask_key=None, sockopt=None, sslopt=None):
+    def __init__(self, get_mask_key=None, sockopt=None, sslopt=None,
+                 max_message_size=None):
         """
         Initalize WebSocket object.
         """
@@ -380,13 +419,21 @@ class WebSocket(object):
             self.sock.setsockopt(*opts)
         self.sslopt = sslopt
         self.get_mask_key = get_mask_key
-        # Buffers over the packets from the layer beneath until desired amount
-        # bytes of bytes are received.
-        self._recv_buffer = []
-        # These buffer over the build-up of a single frame.
+        self.max_message_size = max_message_size
+        # Frames are masked into this buffer, one send at a time.
+        self._send_buffer = bytearray(SEND_BUFFER_SIZE)
+        self._send_lock = threading.Lock()
+        # Buffers over the packets from the layer beneath.  Data between
+        # _recv_start and _recv_end has been received but not consumed.
+        self._recv_buffer = bytearray(RECV_BUFFER_SIZE)
+        self._recv_view = memoryview(self._recv_buffer)
+        self._recv_start = self._recv_end = 0
+        # A payload too large for the buffer, and how much of it has
+        # been received.
+        self._recv_large = None
+        self._recv_filled = 0
+        # The header of the frame whose payload is being received.
         self._frame_header = None
-        self._frame_length = None
-        self._frame_mask = None
         self._cont_data = None
         self.resp_headers = {}
         self.proxy_reps_headers = {}
@@ -553,10 +600,7 @@ class WebSocket(object):
         if traceEnabled:
             logger.debug("--- response header ---")
 
-        while True:
-            line = self._recv_line()
-            if line == "\r\n":
-                break
+        for line in self._recv_header_block().split("\r\n"):
             line = line.strip()
             if traceEnabled:
                 logger.debug(line)
@@ -589,14 +633,37 @@ class WebSocket(object):
         frame = ABNF.create_frame(payload, opcode)
         if self.get_mask_key:
             frame.get_mask_key = self.get_mask_key
-        data = frame.format()
-        length = len(data)
+        with self._send_lock:
+            return self._send_frame(frame)
+
+    def _send_frame(self, frame):
+        frame_header = frame.format_header()
+        if not frame.mask:
+            if traceEnabled:
+                logger.debug("send: " + repr(frame_header + frame.data))
+            self._send_all(frame_header)
+            self._send_all(memoryview(frame.data))
+            return len(frame_header) + len(frame.data)
+
+        # mask the payload straight into the send buffer, right after
+        # the header, so that the frame is sent without joining them.
+        frame_header += frame.get_mask_key(4)
+        offset = len(frame_header)
+        length = offset + len(frame.data)
+        buf = self._send_buffer
+        if length > len(buf):
+            buf = bytearray(length)
+        buf[:offset] = frame_header
+        ABNF.mask_into(frame_header[-4:], frame.data, buf, offset)
         if traceEnabled:
-            logger.debug("send: " + repr(data))
-        while data:
+            logger.debug("send: " + repr(str(buf[:length])))
+        self._send_all(memoryview(buf)[:length])
+        return length
+
+    def _send_all(self, data):
+        while len(data):
             l = self._send(data)
             data = data[l:]
-        return length
 
     def send_binary(self, payload):
         return self.send(payload, ABNF.OPCODE_BINARY)
@@ -641,15 +708,19 @@ class WebSocket(object):
             elif frame.opcode in (ABNF.OPCODE_TEXT, ABNF.OPCODE_BINARY, ABNF.OPCODE_CONT):
                 if frame.opcode == ABNF.OPCODE_CONT and not self._cont_data:
                     raise WebSocketException("Illegal frame")
+                # collect the fragments of a message and join them once
+                # the last one has arrived.
                 if self._cont_data:
-                    self._cont_data[1] += frame.data
+                    self._cont_data[1].append(frame.data)
+                    self._cont_data[2] += len(frame.data)
                 else:
-                    self._cont_data = [frame.opcode, frame.data]
-                
+                    self._cont_data = [frame.opcode, [frame.data],
+                                       len(frame.data)]
+
                 if frame.fin:
-                    data = self._cont_data
+                    opcode, fragments, _ = self._cont_data
                     self._cont_data = None
-                    return data
+                    return [opcode, "".join(fragments)]
             elif frame.opcode == ABNF.OPCODE_CLOSE:
                 self.send_close()
                 return (frame.opcode, None)
@@ -664,40 +735,36 @@ class WebSocket(object):
         """
         # Header
         if self._frame_header is None:
-            self._frame_header = self._recv_strict(2)
-        b1 = ord(self._frame_header[0])
-        fin = b1 >> 7 & 1
-        rsv1 = b1 >> 6 & 1
-        rsv2 = b1 >> 5 & 1
-        rsv3 = b1 >> 4 & 1
-        opcode = b1 & 0xf
-        b2 = ord(self._frame_header[1])
-        has_mask = b2 >> 7 & 1
-        # Frame length
-        if self._frame_length is None:
-            length_bits = b2 & 0x7f
-            if length_bits == 0x7e:
-                length_data = self._recv_strict(2)
-                self._frame_length = struct.unpack("!H", length_data)[0]
-            elif length_bits == 0x7f:
-                length_data = self._recv_strict(8)
-                self._frame_length = struct.unpack("!Q", length_data)[0]
-            else:
-                self._frame_length = length_bits
-        # Mask
-        if self._frame_mask is None:
-            self._frame_mask = self._recv_strict(4) if has_mask else ""
+            self._frame_header = self._recv_header()
+        fin, rsv1, rsv2, rsv3, opcode, has_mask, length, mask_key = \
+            self._frame_header
+        if (self.max_message_size is not None and opcode in
+                (ABNF.OPCODE_TEXT, ABNF.OPCODE_BINARY, ABNF.OPCODE_CONT)):
+            received = self._cont_data[2] if self._cont_data else 0
+            if received + length > self.max_message_size:
+                self._message_too_big()
         # Payload
-        payload = self._recv_strict(self._frame_length)
+        payload = self._recv_strict(length)
         if has_mask:
-            payload = ABNF.mask(self._frame_mask, payload)
+            payload = ABNF.mask(mask_key, payload)
         # Reset for next frame
         self._frame_header = None
-        self._frame_length = None
-        self._frame_mask = None
         return ABNF(fin, rsv1, rsv2, rsv3, opcode, has_mask, payload)
 
 
+    def _message_too_big(self):
+        """
+        Give up on a message larger than max_message_size, without
+        receiving the rest of it.
+        """
+        try:
+            self.send_close(STATUS_MESSAGE_TOO_BIG)
+        except Exception:
+            pass
+        self._closeInternal()
+        raise WebSocketException("Message larger than %d bytes" %
+                                 self.max_message_size)
+
     def send_close(self, status=STATUS_NORMAL, reason=""):
         """
         send close data to the server.
@@ -760,9 +827,9 @@ class WebSocket(object):
             else:
                 raise e
 
-    def _recv(self, bufsize):
+    def _recv_into(self, view):
         try:
-            bytes = self.sock.recv(bufsize)
+            nbytes = self.sock.recv_into(view)
         except socket.timeout as e:
             raise WebSocketTimeoutException(e.message)
         except SSLError as e:
@@ -770,34 +837,98 @@ class WebSocket(object):
                 raise WebSocketTimeoutException(e.message)
             else:
                 raise
-        if not bytes:
+        if not nbytes:
             raise WebSocketConnectionClosedException()
-        return bytes
+        return nbytes
 
-
-    def _recv_strict(self, bufsize):
-        shortage = bufsize - sum(len(x) for x in self._recv_buffer)
-        while shortage > 0:
-            bytes = self._recv(shortage)
-            self._recv_buffer.append(bytes)
-            shortage -= len(bytes)
-        unified = "".join(self._recv_buffer)
-        if shortage == 0:
-            self._recv_buffer = []
-            return unified
+    def _recv_ensure(self, bufsize):
+        """
+        Make sure that at least bufsize bytes are buffered, reading as
+        much as the buffer can hold at a time.
+        """
+        available = self._recv_end - self._recv_start
+        if available >= bufsize:
+            return
+        if self._recv_start + bufsize > len(self._recv_buffer):
+            self._recv_buffer[:available] = self._recv_view[
+                self._recv_start:self._recv_end].tobytes()
+            self._recv_start, self._recv_end = 0, available
+        while self._recv_end - self._recv_start < bufsize:
+            self._recv_end += self._recv_into(
+                self._recv_view[self._recv_end:])
+
+    def _recv_header(self):
+        """
+        Parse a frame header out of the buffer.  Nothing is consumed
+        until the whole header has been received.
+        """
+        self._recv_ensure(2)
+        b1, b2 = struct.unpack_from("!BB", self._recv_buffer,
+                                    self._recv_start)
+        length_bits = b2 & 0x7f
+        has_mask = b2 >> 7 & 1
+        size = 2 + {0x7e: 2, 0x7f: 8}.get(length_bits, 0) + 4 * has_mask
+        self._recv_ensure(size)
+        offset = self._recv_start + 2
+        if length_bits == 0x7e:
+            length = struct.unpack_from("!H", self._recv_buffer, offset)[0]
+            offset += 2
+        elif length_bits == 0x7f:
+            length = struct.unpack_from("!Q", self._recv_buffer, offset)[0]
+            offset += 8
         else:
-            self._recv_buffer = [unified[bufsize:]]
-            return unified[:bufsize]
+            length = length_bits
+        mask_key = self._recv_view[offset:offset + 4].tobytes() \
+            if has_mask else ""
+        self._recv_start += size
+        return (b1 >> 7 & 1, b1 >> 6 & 1, b1 >> 5 & 1, b1 >> 4 & 1,
+                b1 & 0xf, has_mask, length, mask_key)
 
+    def _recv_strict(self, bufsize):
+        if bufsize <= len(self._recv_buffer):
+            self._recv_ensure(bufsize)
+            start = self._recv_start
+            self._recv_start += bufsize
+            return self._recv_view[start:self._recv_start].tobytes()
+
+        # Too large for the buffer; receive straight into the result.
+        if self._recv_large is None:
+            available = self._recv_end - self._recv_start
+            self._recv_large = bytearray(bufsize)
+            self._recv_large[:available] = self._recv_view[
+                self._recv_start:self._recv_end]
+            self._recv_filled = available
+            self._recv_start = self._recv_end = 0
+        view = memoryview(self._recv_large)
+        while self._recv_filled < bufsize:
+            self._recv_filled += self._recv_into(view[self._recv_filled:])
+        data = str(self._recv_large)
+        self._recv_large = None
+        return data
 
-    def _recv_line(self):
-        line = []
+    def _recv_header_block(self):
+        """
+        Receive an HTTP header block, up to the blank line that ends it,
+        reading as much as the buffer can hold at a time.  Whatever
+        follows the block is left in the buffer for the frame reader.
+        """
+        scanned = 0
         while True:
-            c = self._recv(1)
-            line.append(c)
-            if c == "\n":
+            end = self._recv_buffer.find("\r\n\r\n",
+                                         self._recv_start + scanned,
+                                         self._recv_end)
+            if end != -1:
                 break
-        return "".join(line)
+            available = self._recv_end - self._recv_start
+            if available == len(self._recv_buffer):
+                raise WebSocketException("Header block too large")
+            scanned = max(0, available - 3)
+            # asking for one byte more than is buffered reads as much
+            # as there is room for.
+            self._recv_ensure(available + 1)
+        block = self._recv_view[self._recv_start:end].tobytes()
+        self._recv_start = end + 4
+        return block
 
 
 class WebSocketApp(object):
@@ -14,6 +14,9 @@
 
 """Functionality for service discovery."""
 
+import collections
+import heapq
+import itertools
 import logging
 import json
 import random
@@ -23,18 +26,34 @@ import threading
 from urlparse import urljoin, urlsplit, urlunsplit
 
 from circuit import CircuitBreakerSet, CircuitOpenError
+from concurrent import futures
 from requests.exceptions import (RequestException, ConnectionError,
-                                 TooManyRedirects)
+                                 ReadTimeout, TooManyRedirects)
 import requests
 
 from . import errors
+from .balancing import OutlierDetector, RandomBalancer
+from .util import iter_json_object, thread
+
+
+STREAM_CHUNK_SIZE = 64 * 1024
 
 
 class _Registration(object):
-    """A service registration."""
+    """A service registration.
+
+    The registration is refreshed by a thread of its own, or by
+    `manager` if given.
+
+    The announcement is serialized once, and only sent again when it
+    is changed through `update`.  If `lease_only` is true, refreshes
+    in between only ask the registry to extend the lease of the
+    announcement.  Should the registry not support that, full
+    announcements are sent instead.
+    """
 
     def __init__(self, client, form_name, service, instance_name, data,
-                 interval=3):
+                 interval=3, manager=None, lease_only=False):
         self.log = logging.getLogger('{0}.reg.{1}/{2}.{3}'.format(
                 __name__, form_name, service, instance_name))
         self.stopped = threading.Event()
@@ -42,27 +61,76 @@ class _Registration(object):
         self.form_name = form_name
         self.service = service
         self.instance_name = instance_name
-        self.data = data
         self.interval = interval
+        self.manager = manager
+        self.lease_only = lease_only
+        self.uri = '/%s/%s.%s' % (form_name, service, instance_name)
+        self._set_data(data)
+        self._lease_failed = False
+        self._wakeup = threading.Event()
         self._thread = None
 
+    def _set_data(self, data):
+        self.data = data
+        self._body = json.dumps(data)
+        self._announced = False
+
+    def update(self, data):
+        """Change the announcement and send it to the registry right
+        away.
+        """
+        self._set_data(data)
+        if self.manager is not None:
+            self.manager.add(self)
+        else:
+            self._wakeup.set()
+
+    def _announce(self):
+        body = self._body
+        response = self.client._request(
+            'PUT', self.uri, data=body, timeout=self.interval)
+        # the data may have been updated while the request was in
+        # flight, in which case the new data has not been announced.
+        if self._body is body:
+            self._announced = response.status_code < 400
+
+    def _extend(self):
+        response = self.client._request(
+            'POST', self.uri + '/lease', timeout=self.interval)
+        if response.status_code < 400:
+            self._lease_failed = False
+            return
+        if self._lease_failed:
+            self.log.warning("registry does not extend leases; "
+                             "sending full announcements")
+            self.lease_only = False
+        self._lease_failed = True
+        self._announce()
+
+    def _refresh(self):
+        t0 = time.time()
+        try:
+            if self.lease_only and self._announced:
+                self._extend()
+            else:
+                self._announce()
+        except Exception:
+            self.log.exception("could not talk to service registry")
+
+        t1 = time.time()
+        self.log.debug("time to update service registry: {0:.03f}".format(
+                t1 - t0))
+
     def _loop(self):
-        uri = '/%s/%s.%s' % (self.form_name, self.service, self.instance_name)
         while not self.stopped.isSet():
-            t0 = time.time()
-            try:
-                response = self.client._request(
-                    'PUT', uri, data=json.dumps(self.data),
-                    timeout=self.interval)
-            except Exception:
-                self.log.exception("could not talk to service registry")
-
-            t1 = time.time()
-            self.log.debug("time to update service registry: {0:.03f}".format(
-                    t1 - t0))
-            self.stopped.wait(self.interval)
+            self._refresh()
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
 
     def start(self):
+        if self.manager is not None:
+            self.manager.add(self)
+            return self
         self._thread = threading.Thread(target=self._loop)
         self._thread.daemon = True
         self._thread.start()
@@ -70,19 +138,117 @@ class _Registration(object):
 
     def stop(self, timeout=None):
         self.stopped.set()
-        self._thread.join(timeout)
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+
+class _RegistrationManager(object):
+    """Schedules refreshes of all registrations of a client from a
+    single thread, and refreshes them with a pool of at most
+    `max_workers` threads.
+
+    Each registration is refreshed every `interval` seconds, give or
+    take `jitter` of the interval, so that registrations that were
+    made at the same time spread out over time.
+    """
+
+    def __init__(self, clock, jitter=0.1, max_workers=4):
+        self.clock = clock
+        self.jitter = jitter
+        self.max_workers = max_workers
+        self._queue = []
+        self._current = {}
+        self._running = set()
+        self._deferred = set()
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._thread = None
+        self._pool = None
+
+    def add(self, registration):
+        """Refresh `registration` now and then periodically until it
+        is stopped.
+        """
+        with self._cond:
+            self._schedule(self.clock.time(), registration)
+            if self._thread is None:
+                self._pool = futures.ThreadPoolExecutor(self.max_workers)
+                self._thread = thread(self._loop)
+            self._cond.notify()
+
+    def _schedule(self, when, registration):
+        seq = next(self._seq)
+        self._current[registration] = seq
+        heapq.heappush(self._queue, (when, seq, registration))
+
+    def _next(self):
+        with self._cond:
+            while True:
+                while self._queue:
+                    _, seq, registration = self._queue[0]
+                    if registration.stopped.isSet():
+                        self._current.pop(registration, None)
+                    elif self._current.get(registration) == seq:
+                        break
+                    heapq.heappop(self._queue)
+                if not self._queue:
+                    self._cond.wait()
+                    continue
+                delay = self._queue[0][0] - self.clock.time()
+                if delay > 0:
+                    self._cond.wait(delay)
+                    continue
+                return heapq.heappop(self._queue)
+
+    def _loop(self):
+        while True:
+            when, seq, registration = self._next()
+            with self._cond:
+                if registration in self._running:
+                    # refreshed again once the running refresh is done.
+                    self._deferred.add(registration)
+                    continue
+                self._running.add(registration)
+            self._pool.submit(self._refresh, when, seq, registration)
+
+    def _refresh(self, when, seq, registration):
+        try:
+            registration._refresh()
+        finally:
+            jitter = random.uniform(-self.jitter, self.jitter)
+            with self._cond:
+                self._running.discard(registration)
+                if registration in self._deferred:
+                    self._deferred.discard(registration)
+                    self._schedule(self.clock.time(), registration)
+                # the registration may have been rescheduled by an
+                # update while it was being refreshed.
+                elif self._current.get(registration) == seq:
+                    self._schedule(
+                        max(when + registration.interval * (1 + jitter),
+                            self.clock.time()), registration)
+                self._cond.notify()
 
 
 class _FormationCache(object):
-    """A cache of instance data for a formation."""
+    """A cache of instance data for a formation.
 
-    def __init__(self, client, form_name, factory, interval):
+    If `watch` is true the formation is fetched with a conditional
+    request, and only instances that were added, changed or removed
+    since the last fetch are applied to the cache.
+    """
+
+    def __init__(self, client, form_name, factory, interval, watch=False):
         self.client = client
         self.form_name = form_name
         self.factory = factory
         self.interval = interval
+        self.watch = watch
         self._thread = None
         self._cache = {}
+        self._raw = {}
+        self._etag = None
         self._stopped = threading.Event()
         self._running = threading.Event()
         self._lock = threading.Lock()
@@ -99,10 +265,28 @@ class _FormationCache(object):
         self._thread.join(timeout)
 
     def _update(self):
+        if self.watch:
+            self._watch()
+            return
         with self._lock:
             self._cache = dict(self.client.query_formation(
                     self.form_name, self.factory))
 
+    def _watch(self):
+        etag, raw = self.client.poll_formation(self.form_name, self._etag)
+        if raw is None:
+            return
+        self._etag = etag
+        changed = dict((k, self.factory(d)) for (k, d) in raw.items()
+                       if self._raw.get(k) != d)
+        removed = [k for k in self._raw if k not in raw]
+        self._raw = raw
+        if changed or removed:
+            with self._lock:
+                for k in removed:
+                    del self._cache[k]
+                self._cache.update(changed)
+
     def _loop(self):
         while not self._stopped.isSet():
             self._update()
@@ -115,12 +299,39 @@ class _FormationCache(object):
             return dict(self._cache)
 
 
+def _endpoints(alts, port):
+    """Return `(host, port)` of the announcements in `alts` that
+    expose `port`.
+    """
+    key = str(port)
+    return [(alt['host'], int(alt['ports'][key])) for alt in alts
+            if key in alt['ports']]
+
+
 class Resolver(object):
-    """Resolver."""
+    """Resolver.
+
+    :param balancer: A :class:`Balancer <gilliam.balancing.Balancer>`
+        that picks which instance of a service to resolve to.
+        Defaults to picking one at random.
+
+    :param negative_ttl: For how many seconds a failed resolution is
+        remembered and failed again without asking the registry.
 
-    def __init__(self, client, search_domain=''):
+    :param outliers: An :class:`OutlierDetector
+        <gilliam.balancing.OutlierDetector>` that decides which
+        instances should not be handed out for a while.
+    """
+
+    def __init__(self, client, search_domain='', balancer=None,
+                 negative_ttl=1, outliers=None, clock=time):
         self.client = client
         self.search_domain = search_domain.split('.')
+        self.balancer = balancer or RandomBalancer()
+        self.negative_ttl = negative_ttl
+        self.outliers = outliers or OutlierDetector(clock=clock)
+        self.clock = clock
+        self._negative = {}
 
     def resolve_url(self, url):
         """Given a URL, return a resolved url."""
@@ -133,7 +344,29 @@ class Resolver(object):
         """Given a host and a port, return resolved host and port."""
         if '.' in host and not host.endswith(".service"):
             return host, port
-        return self._resolve(host, port)
+
+        key = (host, port)
+        failure = self._negative.get(key)
+        if failure is not None:
+            err, expires = failure
+            if self.clock.time() < expires:
+                raise err
+            self._negative.pop(key, None)
+
+        try:
+            return self._resolve(host, port)
+        except errors.ResolveError, err:
+            if self.negative_ttl:
+                self._remember_failure(key, err)
+            raise
+
+    def _remember_failure(self, key, err):
+        now = self.clock.time()
+        if len(self._negative) >= 1024:
+            for k, (_, expires) in self._negative.items():
+                if expires <= now:
+                    self._negative.pop(k, None)
+        self._negative[key] = (err, now + self.negative_ttl)
 
     def _resolve(self, host, port):
         parts = host.split('.')
@@ -158,6 +391,22 @@ class Resolver(object):
         return [d for (k, d) in self.client.query_formation(formation)
                 if all((d[attr].lower() == v) for (attr, v) in filters.items())]
 
+    def _service_alts(self, formation, service):
+        """Return announcements of all instances of `service`."""
+        return self._select(formation, service=service)
+
+    def _instance_alts(self, formation, service, instance):
+        """Return announcements of `instance` of `service`."""
+        return self._select(formation, service=service,
+                            instance=instance.lower())
+
+    def _service_endpoints(self, formation, service, port):
+        """Return the announcements of all instances of `service`,
+        and the endpoints of those that expose `port`.
+        """
+        alts = self._service_alts(formation, service)
+        return alts, _endpoints(alts, port)
+
     def _resolve_port(self, announcement, port):
         """Resolve port mapping in instance announcement."""
         if str(port) not in announcement['ports']:
@@ -167,8 +416,7 @@ class Resolver(object):
     def _resolve_one(self, port, instance, service, formation):
         """Resolve a specific instance of a service in a formation.
         """
-        alts = self._select(formation, service=service,
-                            instance=instance.lower())
+        alts = self._instance_alts(formation, service, instance)
         if not alts:
             raise errors.ResolveError("%s.%s.%s.service:%d: no such instance" % (
                     instance, service, formation, port))
@@ -181,19 +429,156 @@ class Resolver(object):
         """Resolve to any of the instances for the specified
         service.
         """
-        alts = self._select(formation, service=service)
+        alts, endpoints = self._service_endpoints(formation, service, port)
         if not alts:
             raise errors.ResolveError("%s.%s.service:%d: no instances" % (
                     service, formation, port))
+        if not endpoints:
+            raise errors.ResolveError('port %d not exposed' % (port,))
 
-        alt = random.choice(alts)
-        return alt['host'], self._resolve_port(alt, port)
+        return self.balancer.choose(self.outliers.filter(endpoints))
+
+
+class _FormationSnapshot(object):
+    """An indexed, point-in-time view of the instances of a
+    formation.
+    """
+
+    def __init__(self, instances, etag, fetched_at):
+        self.etag = etag
+        self.fetched_at = fetched_at
+        self.by_service = {}
+        self.by_instance = {}
+        self.endpoints = {}
+        for data in instances:
+            service = data['service'].lower()
+            self.by_service.setdefault(service, []).append(data)
+            self.by_instance.setdefault(
+                (data['instance'].lower(), service), []).append(data)
+
+
+class CachedResolver(Resolver):
+    """Resolver that answers from a per-formation snapshot held in
+    memory rather than querying the registry for every resolution.
+
+    A snapshot younger than `ttl` seconds is used as is.  A snapshot
+    that is older than that, but still within `stale` seconds past its
+    TTL, is used while a fresh copy is fetched in the background.
+    Anything older than that is refetched before answering, once for
+    all callers that need it at the same time.
+    """
+
+    def __init__(self, client, search_domain='', ttl=5, stale=30,
+                 clock=time, balancer=None, negative_ttl=1, outliers=None):
+        Resolver.__init__(self, client, search_domain, balancer,
+                          negative_ttl, outliers, clock)
+        self.ttl = ttl
+        self.stale = stale
+        self.log = logging.getLogger('{0}.resolver'.format(__name__))
+        self._snapshots = {}
+        self._refreshing = set()
+        self._fetching = {}
+        self._lock = threading.Lock()
 
+    def _fetch(self, formation):
+        previous = self._snapshots.get(formation)
+        etag, instances = self.client.poll_formation(
+            formation, previous.etag if previous is not None else None)
+        if instances is None:
+            previous.fetched_at = self.clock.time()
+            return previous
+        snapshot = _FormationSnapshot(instances.values(), etag,
+                                      self.clock.time())
+        self._snapshots[formation] = snapshot
+        return snapshot
+
+    def _refresh(self, formation):
+        try:
+            self._fetch(formation)
+        except Exception:
+            self.log.exception("could not refresh formation %s" % (
+                    formation,))
+        finally:
+            with self._lock:
+                self._refreshing.discard(formation)
+
+    def _fetch_shared(self, formation):
+        """Fetch `formation` unless another caller fetched it while
+        this one was waiting to.
+        """
+        with self._lock:
+            lock = self._fetching.setdefault(formation, threading.Lock())
+        with lock:
+            snapshot = self._snapshots.get(formation)
+            if snapshot is not None and (self.clock.time()
+                    - snapshot.fetched_at < self.ttl + self.stale):
+                return snapshot
+            return self._fetch(formation)
+
+    def _snapshot(self, formation):
+        snapshot = self._snapshots.get(formation)
+        if snapshot is None:
+            return self._fetch_shared(formation)
+        age = self.clock.time() - snapshot.fetched_at
+        if age < self.ttl:
+            return snapshot
+        elif age < self.ttl + self.stale:
+            with self._lock:
+                if formation in self._refreshing:
+                    return snapshot
+                self._refreshing.add(formation)
+            thread(self._refresh, formation)
+            return snapshot
+        return self._fetch_shared(formation)
+
+    def _service_alts(self, formation, service):
+        return self._snapshot(formation).by_service.get(
+            service.lower(), [])
+
+    def _instance_alts(self, formation, service, instance):
+        return self._snapshot(formation).by_instance.get(
+            (instance.lower(), service.lower()), [])
+
+    def _service_endpoints(self, formation, service, port):
+        snapshot = self._snapshot(formation)
+        key = (service.lower(), port)
+        try:
+            return snapshot.endpoints[key]
+        except KeyError:
+            alts = snapshot.by_service.get(key[0], [])
+            result = snapshot.endpoints[key] = (alts, _endpoints(alts, port))
+            return result
 
-class ServiceRegistryClient(object):
 
-    def __init__(self, clock, cluster_nodes=None):
+class ServiceRegistryClient(object):
+    """Client for the service registry cluster.
+
+    :param shared_registrations: If true, all registrations made
+        through the client are refreshed by a small shared pool of
+        threads rather than a thread each.
+
+    :param hedge: If true, a GET request is first sent to the node
+        that has recently answered the quickest.  If that node has not
+        answered within the `hedge_percentile` of recently observed
+        response times, the request is abandoned and sent to the next
+        node instead.  Until enough response times have been observed,
+        `hedge_delay` seconds is used.
+    """
+
+    def __init__(self, clock, cluster_nodes=None, hedge=False,
+                 hedge_percentile=95, hedge_delay=0.05,
+                 shared_registrations=False):
         self.clock = clock
+        self._registrations = (_RegistrationManager(clock)
+                               if shared_registrations else None)
+        self.hedge = hedge
+        self.hedge_percentile = hedge_percentile
+        self.hedge_delay = hedge_delay
+        self.hedge_stats = {'requests': 0, 'hedged': 0,
+                            'wins': collections.Counter()}
+        self._latencies = collections.deque(maxlen=256)
+        self._node_latencies = {}
+        self._stats_lock = threading.Lock()
         self.cluster_nodes = []
         if cluster_nodes is None:
             cluster_nodes = os.getenv(
@@ -211,24 +596,112 @@ class ServiceRegistryClient(object):
         # backward compatible
         self.resolve = Resolver(self).resolve_url
 
+    def _attempt(self, node, session, method, uri, hedge=False, **kwargs):
+        with self.breaker.context(node):
+            try:
+                response = session.request(method, urljoin(node, uri),
+                                           **kwargs)
+            except ReadTimeout:
+                if not hedge:
+                    raise
+                # the node is not broken, just slower than we were
+                # willing to wait for; don't count it against it.
+                return None
+            if response.status_code >= 500:
+                raise RequestException()
+            return response
+
     def _request(self, method, uri, **kwargs):
         """Issue a request to SOME of the nodes in the cluster."""
+        if self.hedge and method == 'GET' and len(self.cluster_nodes) > 1:
+            return self._hedged_request(method, uri, **kwargs)
         for node, session in self.cluster_nodes:
             try:
-                with self.breaker.context(node):
-                    response = session.request(method, urljoin(node, uri),
-                                               **kwargs)
-                    if response.status_code >= 500:
-                        raise RequestException()
-                    return response
+                return self._attempt(node, session, method, uri, **kwargs)
             except CircuitOpenError:
                 continue
         else:
             raise Exception("NO MACHIEN TO TALK TOOO")
 
-    def register(self, form_name, service, instance_name, data):
-        """Register an instance with a formation."""
-        return _Registration(self, form_name, service, instance_name, data).start()
+    def _current_hedge_delay(self):
+        latencies = sorted(self._latencies)
+        if len(latencies) < 16:
+            return self.hedge_delay
+        index = len(latencies) * self.hedge_percentile // 100
+        return latencies[min(index, len(latencies) - 1)]
+
+    def _node_latency(self, cluster_node):
+        latencies = self._node_latencies.get(cluster_node[0])
+        if not latencies:
+            return 0
+        return sum(latencies) / len(latencies)
+
+    def _hedged_request(self, method, uri, **kwargs):
+        """Issue a request to the node that has recently answered the
+        quickest.  If it does not answer within the hedge delay, give
+        up on it and try the next one.  The last node gets as long as
+        the request allows.
+        """
+        nodes = sorted(self.cluster_nodes, key=self._node_latency)
+        delay = self._current_hedge_delay()
+        timeout = kwargs.pop('timeout', None)
+        hedged, error = False, None
+        with self._stats_lock:
+            self.hedge_stats['requests'] += 1
+
+        for index, (node, session) in enumerate(nodes):
+            last = index == len(nodes) - 1
+            if last:
+                attempt_timeout = timeout
+            else:
+                attempt_timeout = (delay if timeout is None
+                                   else min(delay, timeout))
+            t0 = self.clock.time()
+            try:
+                response = self._attempt(node, session, method, uri,
+                                         hedge=not last,
+                                         timeout=attempt_timeout,
+                                         **kwargs)
+            except CircuitOpenError:
+                continue
+            except Exception, err:
+                error = err
+                continue
+
+            if response is None:
+                self._node_latencies.setdefault(
+                    node, collections.deque(maxlen=32)).append(delay)
+                if not hedged:
+                    hedged = True
+                    with self._stats_lock:
+                        self.hedge_stats['hedged'] += 1
+                continue
+
+            elapsed = self.clock.time() - t0
+            self._latencies.append(elapsed)
+            self._node_latencies.setdefault(
+                node, collections.deque(maxlen=32)).append(elapsed)
+            with self._stats_lock:
+                self.hedge_stats['wins'][node] += 1
+            return response
+
+        if error is not None:
+            raise error
+        raise Exception("NO MACHIEN TO TALK TOOO")
+
+    def register(self, form_name, service, instance_name, data,
+                 lease_only=False):
+        """Register an instance with a formation.
+
+        Returns a registration that is kept alive until stopped.  Use
+        its `update` method to change the announcement.
+
+        @param lease_only: Only send the announcement when it changes,
+            and otherwise just extend its lease.
+        """
+        return _Registration(self, form_name, service, instance_name, data,
+                             manager=self._registrations,
+                             lease_only=lease_only).start()
 
     def build_announcement(self, formation, service, instance,
                            ports={}, **kwargs):
@@ -239,7 +712,7 @@ class ServiceRegistryClient(object):
         announcement.update(kwargs)
         return announcement
 
-    def query_formation(self, form_name, factory=dict):
+    def query_formation(self, form_name, factory=dict, stream=False):
         """Query all instances of a formation.
         
         Will return a generator that yields (instance name, data) for
@@ -248,17 +721,52 @@ class ServiceRegistryClient(object):
         @param factory: Data factory.  Will be passed a JSON object of
             the instance data, expects to return a representation of
             that data.
+
+        @param stream: Decode the response while it is being read, and
+            yield each instance as soon as it has been decoded, rather
+            than reading the whole response first.
+        """
+        response = self._request('GET', '/%s' % (form_name,), stream=stream)
+        response.raise_for_status()
+        if not stream:
+            for key, data in response.json().items():
+                yield (key, factory(data))
+            return
+        try:
+            for key, data in iter_json_object(
+                    response.iter_content(STREAM_CHUNK_SIZE)):
+                yield (key, factory(data))
+        finally:
+            response.close()
+
+    def poll_formation(self, form_name, etag=None):
+        """Conditionally query all instances of a formation.
+
+        Returns a `(etag, instances)` tuple, where `instances` is a
+        dict of instance name to the raw instance data.  If the
+        formation has not changed since `etag` was handed out,
+        `instances` is `None`.
         """
-        response = self._request('GET', '/%s' % (form_name,))
+        headers = {}
+        if etag is not None:
+            headers['If-None-Match'] = etag
+        response = self._request('GET', '/%s' % (form_name,),
+                                 headers=headers)
+        if response.status_code == 304:
+            return etag, None
         response.raise_for_status()
-        for key, data in response.json().items():
-            yield (key, factory(data))
+        return response.headers.get('etag'), response.json()
 
-    def formation_cache(self, form_name, factory=dict, interval=15):
+    def formation_cache(self, form_name, factory=dict, interval=15,
+                        watch=False):
         """Return a cache for a specific formation that will be kept
         up to date until stopped.
+
+        @param watch: Only fetch and apply changes to the formation,
+            rather than rebuilding the cache every `interval` seconds.
         """
-        return _FormationCache(self, form_name, factory, interval).start()
+        return _FormationCache(self, form_name, factory, interval,
+                               watch).start()
 
 
 def make_client():
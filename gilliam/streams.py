@@ -0,0 +1,373 @@
+# Copyright 2013 Johan Rydberg.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Helpers for moving data between files and attached processes."""
+
+from functools import partial
+import collections
+import errno
+import logging
+import os
+import select
+import socket
+import ssl
+import tempfile
+import threading
+import time
+
+from concurrent import futures
+
+from .packages import websocket
+from .util import thread
+
+
+def read_chunks(input, chunk_size=64 * 1024, window=0.005, clock=time):
+    """Yield the data of `input` in chunks of at most `chunk_size`
+    bytes.
+
+    If `input` has a file descriptor, whatever is available is read
+    from it straight away.  After a read that did not fill a chunk,
+    data that arrives within another `window` seconds is added to the
+    same chunk, so that a burst of small writes ends up in one chunk
+    while a single keystroke is still passed on promptly.
+
+    Other file-like objects are read `chunk_size` bytes at a time, and
+    anything else is iterated as is.
+    """
+    try:
+        fd = input.fileno()
+    except (AttributeError, IOError, ValueError):
+        fd = None
+
+    if fd is None:
+        if hasattr(input, 'read'):
+            input = iter(partial(input.read, chunk_size), '')
+        for data in input:
+            yield data
+        return
+
+    while True:
+        data = os.read(fd, chunk_size)
+        if not data:
+            return
+        if window and len(data) < chunk_size:
+            parts, size = [data], len(data)
+            deadline = clock.time() + window
+            while size < chunk_size:
+                remaining = deadline - clock.time()
+                if remaining <= 0:
+                    break
+                readable, _, _ = select.select([fd], [], [], remaining)
+                if not readable:
+                    break
+                more = os.read(fd, chunk_size - size)
+                if not more:
+                    yield ''.join(parts)
+                    return
+                parts.append(more)
+                size += len(more)
+            data = ''.join(parts)
+        yield data
+
+
+class OutputPump(object):
+    """Writes data to `output` from a thread of its own, so that a
+    slow `output` does not hold up whoever produces the data.
+
+    Up to `max_buffer` bytes are held in memory.  What happens when
+    the buffer is full depends on `overflow`:
+
+    - ``'block'``: :meth:`put` waits until there is room.
+    - ``'drop'``: the data is discarded and counted in `dropped`.
+    - ``'spill'``: the data is written to a temporary file, and
+      written to `output` once everything before it has been.
+
+    `output` is flushed after every write if `flush` is 0, at most
+    every `flush` seconds if it is positive, and only when the pump is
+    closed if it is `None`.
+
+    Should writing to `output` fail, the error is raised by the next
+    call to :meth:`put` or :meth:`close`.
+    """
+
+    def __init__(self, output, max_buffer=4 * 1024 * 1024, flush=0,
+                 overflow='block', clock=time):
+        if overflow not in ('block', 'drop', 'spill'):
+            raise ValueError("overflow must be 'block', 'drop' or 'spill'")
+        self.output = output
+        self.max_buffer = max_buffer
+        self.flush = flush
+        self.overflow = overflow
+        self.clock = clock
+        self.dropped = 0
+        self._chunks = collections.deque()
+        self._size = 0
+        self._spill = None
+        self._spill_read = self._spill_write = 0
+        self._closed = False
+        self._error = None
+        self._cond = threading.Condition()
+        self._thread = thread(self._loop)
+
+    def put(self, data):
+        """Queue `data` to be written to the output."""
+        with self._cond:
+            if self._error is not None:
+                raise self._error
+            if self._closed:
+                raise ValueError("pump is closed")
+            if self._spill_write > self._spill_read:
+                self._spill_data(data)
+                return
+            while self._size + len(data) > self.max_buffer and self._size:
+                if self.overflow == 'drop':
+                    self.dropped += len(data)
+                    return
+                elif self.overflow == 'spill':
+                    self._spill_data(data)
+                    return
+                self._cond.wait()
+                if self._error is not None:
+                    raise self._error
+            self._chunks.append(data)
+            self._size += len(data)
+            self._cond.notify_all()
+
+    def close(self, timeout=None):
+        """Write out everything that has been queued, flush the
+        output and stop the pump.
+        """
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self._thread.join(timeout)
+        if self._error is not None:
+            raise self._error
+
+    def _spill_data(self, data):
+        if self._spill is None:
+            self._spill = tempfile.TemporaryFile()
+        self._spill.seek(self._spill_write)
+        self._spill.write(data)
+        self._spill_write += len(data)
+        self._cond.notify_all()
+
+    def _take(self):
+        """Return all data in memory, or else the next piece of
+        spilled data.
+        """
+        if self._chunks:
+            data = ''.join(self._chunks)
+            self._chunks.clear()
+            self._size = 0
+        else:
+            self._spill.seek(self._spill_read)
+            data = self._spill.read(min(self.max_buffer,
+                                        self._spill_write - self._spill_read))
+            self._spill_read += len(data)
+            if self._spill_read == self._spill_write:
+                self._spill.truncate(0)
+                self._spill_read = self._spill_write = 0
+        self._cond.notify_all()
+        return data
+
+    def _loop(self):
+        try:
+            self._pump()
+        except Exception, err:
+            with self._cond:
+                self._error = err
+                self._chunks.clear()
+                self._size = 0
+                self._cond.notify_all()
+        finally:
+            if self._spill is not None:
+                self._spill.close()
+
+    def _pump(self):
+        flushed, dirty = self.clock.time(), False
+        while True:
+            with self._cond:
+                while not (self._chunks or self._spill_write or self._closed):
+                    if dirty and self.flush:
+                        self._cond.wait(max(0, flushed + self.flush
+                                            - self.clock.time()))
+                        break
+                    self._cond.wait()
+                if self._chunks or self._spill_write:
+                    data = self._take()
+                elif self._closed:
+                    break
+                else:
+                    data = ''
+            if data:
+                self.output.write(data)
+                dirty = True
+            if dirty and self.flush is not None and (
+                    self.clock.time() - flushed >= self.flush):
+                self.output.flush()
+                flushed, dirty = self.clock.time(), False
+        if dirty:
+            self.output.flush()
+
+
+_POLLIN = getattr(select, 'POLLIN', 1)
+
+
+class _SelectPoller(object):
+    """Stand-in for `select.poll` on platforms that lack it."""
+
+    def __init__(self):
+        self._fds = set()
+
+    def register(self, fd, eventmask=_POLLIN):
+        self._fds.add(fd)
+
+    def unregister(self, fd):
+        self._fds.discard(fd)
+
+    def poll(self, timeout=None):
+        readable, _, _ = select.select(list(self._fds), [], [], timeout)
+        return [(fd, _POLLIN) for fd in readable]
+
+
+def _would_block(err):
+    if isinstance(err, ssl.SSLError):
+        return err.args[0] == ssl.SSL_ERROR_WANT_READ
+    return err.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK)
+
+
+class AttachMultiplexer(object):
+    """Moves the output of many attached processes to their outputs
+    from a single thread, no matter how many there are.
+
+    The thread blocks while an output is being written to, so outputs
+    should be quick to write to; wrap slow ones in an
+    :class:`OutputPump`.
+
+    :param max_pump_messages: Number of messages moved from one
+        connection before the others get their turn.
+
+    :param max_pump_bytes: Number of bytes moved from one connection
+        before the others get their turn.
+    """
+
+    def __init__(self, max_pump_messages=16, max_pump_bytes=64 * 1024):
+        self.log = logging.getLogger('{0}.multiplexer'.format(__name__))
+        self.max_pump_messages = max_pump_messages
+        self.max_pump_bytes = max_pump_bytes
+        self._conns = {}
+        self._ready = set()
+        self._added = []
+        self._lock = threading.Lock()
+        self._wakeup_r = self._wakeup_w = None
+        self._thread = None
+
+    def add(self, ws, output):
+        """Write everything received on websocket `ws` to `output`.
+
+        Returns a future that is resolved once the connection is
+        closed.  Cancel the future to close the connection.
+        """
+        future = futures.Future()
+        ws.sock.setblocking(0)
+        with self._lock:
+            self._added.append((ws, output, future))
+            if self._thread is None:
+                self._wakeup_r, self._wakeup_w = os.pipe()
+                self._thread = thread(self._loop)
+        future.add_done_callback(lambda future: self._wake())
+        self._wake()
+        return future
+
+    def _wake(self):
+        os.write(self._wakeup_w, 'x')
+
+    def _update(self, poller):
+        """Register added connections and drop cancelled ones."""
+        with self._lock:
+            added, self._added = self._added, []
+        for ws, output, future in added:
+            self._conns[ws.fileno()] = (ws, output, future)
+            poller.register(ws.fileno(), _POLLIN)
+        for fd, (ws, output, future) in self._conns.items():
+            if future.cancelled():
+                self._finish(poller, fd)
+        # frames that arrived along with the handshake are already
+        # buffered by the websocket, and will not make it readable.
+        for ws, output, future in added:
+            if ws.fileno() in self._conns:
+                self._pump(poller, ws.fileno())
+
+    def _finish(self, poller, fd, err=None):
+        ws, output, future = self._conns.pop(fd)
+        self._ready.discard(fd)
+        poller.unregister(fd)
+        # the closing handshake, if any, is already done.
+        ws._closeInternal()
+        if not future.set_running_or_notify_cancel():
+            return
+        if err is not None:
+            future.set_exception(err)
+        else:
+            future.set_result(None)
+
+    def _pump(self, poller, fd):
+        """Move data that has arrived on `fd` to its output, up to
+        `max_pump_messages` messages or `max_pump_bytes` bytes.
+        """
+        ws, output, future = self._conns[fd]
+        messages = moved = 0
+        try:
+            while (messages < self.max_pump_messages
+                   and moved < self.max_pump_bytes):
+                data = ws.recv()
+                if not data:
+                    break
+                output.write(data)
+                messages += 1
+                moved += len(data)
+            else:
+                # data already buffered by the websocket will not make
+                # the socket readable again, so come back for it.
+                if ws._recv_end > ws._recv_start:
+                    self._ready.add(fd)
+                return
+        except socket.error, err:
+            if _would_block(err):
+                return
+            self._finish(poller, fd, err)
+        except websocket.WebSocketConnectionClosedException:
+            self._finish(poller, fd)
+        except Exception, err:
+            self.log.debug("could not move output: %s" % (err,))
+            self._finish(poller, fd, err)
+        else:
+            self._finish(poller, fd)
+
+    def _loop(self):
+        poller = select.poll() if hasattr(select, 'poll') else _SelectPoller()
+        poller.register(self._wakeup_r, _POLLIN)
+        while True:
+            ready, self._ready = self._ready, set()
+            for fd, event in poller.poll(0 if ready else None):
+                if fd == self._wakeup_r:
+                    os.read(self._wakeup_r, 4096)
+                    self._update(poller)
+                elif fd in self._conns:
+                    ready.discard(fd)
+                    self._pump(poller, fd)
+            for fd in ready:
+                if fd in self._conns:
+                    self._pump(poller, fd)
@@ -13,6 +13,8 @@
 # limitations under the License.
 
 from urlparse import urljoin
+import json
+import re
 import threading
 
 
@@ -34,3 +36,98 @@ def thread(fn, *args, **kw):
     t.daemon = True
     t.start()
     return t
+
+
+_WHITESPACE = re.compile(r'[ \t\n\r]*')
+_DELIMITERS = frozenset(' \t\n\r,:]}')
+
+
+class _JSONReader(object):
+    """Decodes JSON values one at a time out of a stream of chunks."""
+
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._decoder = json.JSONDecoder()
+        self.buf = ''
+        self.pos = 0
+
+    def _fill(self):
+        for chunk in self._chunks:
+            if chunk:
+                self.buf = self.buf[self.pos:] + chunk
+                self.pos = 0
+                return True
+        return False
+
+    def peek(self):
+        """Skip whitespace and return the next character."""
+        while True:
+            self.pos = _WHITESPACE.match(self.buf, self.pos).end()
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self._fill():
+                raise ValueError("unexpected end of JSON data")
+
+    def expect(self, c):
+        if self.peek() != c:
+            raise ValueError("expected %r in JSON data" % (c,))
+        self.pos += 1
+
+    def value(self):
+        self.peek()
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self.buf, self.pos)
+            except ValueError:
+                if not self._fill():
+                    raise
+                continue
+            # a number that is not followed by a delimiter may
+            # continue in the next chunk.
+            if self.buf[end:end + 1] not in _DELIMITERS and self._fill():
+                continue
+            self.pos = end
+            return value
+
+
+def iter_json_object(chunks):
+    """Incrementally decode a JSON object from an iterable of string
+    chunks, yielding `(key, value)` for each member as soon as it has
+    been decoded.
+    """
+    reader = _JSONReader(chunks)
+    reader.expect('{')
+    if reader.peek() == '}':
+        return
+    while True:
+        key = reader.value()
+        reader.expect(':')
+        yield key, reader.value()
+        c = reader.peek()
+        reader.pos += 1
+        if c == '}':
+            return
+        elif c != ',':
+            raise ValueError("expected ',' or '}' in JSON data")
+
+
+def iter_lines(chunks):
+    """Split an iterable of string chunks into lines, yielding each
+    non-empty line, without its line ending, as soon as it is
+    complete.
+    """
+    pending = []
+    for chunk in chunks:
+        if '\n' not in chunk:
+            pending.append(chunk)
+            continue
+        pending.append(chunk)
+        lines = ''.join(pending).split('\n')
+        pending = [lines.pop()]
+        for line in lines:
+            line = line.rstrip('\r')
+            if line:
+                yield line
+    line = ''.join(pending).rstrip('\r')
+    if line:
+        yield line
@@ -20,7 +20,11 @@ setup(
     license='Apache 2.0',
     cmdclass=commands,
     install_requires=[
-        'requests >= 2.0',
-        'python-circuit'
-        ]
+        'requests >= 2.9',
+        'python-circuit',
+        'futures',
+        ],
+    extras_require={
+        'asyncio': ['trollius'],
+        }
 )